@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import json
+import random
+import time
+from optparse import make_option
+
+import django
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+import pollup
+from pollup.models import Poll, PollChoice, PollChoiceVote
+
+from simpleapp.models import SimpleModel
+
+SLUG_PREFIX = 'pollup-bench-'
+
+
+def fake_ip(n):
+    return '10.%d.%d.%d' % ((n >> 16) & 255, (n >> 8) & 255, n & 255)
+
+
+class Command(BaseCommand):
+    help = "Time pollup's hot paths against synthetic polls and print the results as JSON."
+    option_list = BaseCommand.option_list + (
+        make_option('--polls', type='int', default=5,
+            help='Number of polls to create.'),
+        make_option('--choices', type='int', default=10,
+            help='Number of choices per poll.'),
+        make_option('--votes', type='int', default=1000,
+            help='Number of votes cast per poll.'),
+        make_option('--objects', type='int', default=100,
+            help='Number of pollable SimpleModel objects.'),
+        make_option('--seed', type='int', default=0,
+            help='Random seed, runs with the same seed build the same data.'),
+    )
+
+    def measure(self, name, func, *args, **kwargs):
+        use_debug_cursor = connection.use_debug_cursor
+        connection.use_debug_cursor = True
+        queries_before = len(connection.queries)
+        start = time.time()
+        try:
+            func(*args, **kwargs)
+        finally:
+            self.results[name] = {
+                'seconds': time.time() - start,
+                'queries': len(connection.queries) - queries_before,
+            }
+            connection.use_debug_cursor = use_debug_cursor
+
+    def handle(self, **options):
+        self.results = {}
+        params = dict((key, options[key]) for key in ('polls', 'choices', 'votes', 'objects', 'seed'))
+        rng = random.Random(params['seed'])
+        self.cleanup()
+        try:
+            self.run(params, rng)
+        finally:
+            self.cleanup()
+        self.stdout.write(json.dumps({
+            'pollup': pollup.get_version(),
+            'django': django.get_version(),
+            'database': connection.vendor,
+            'params': params,
+            'results': self.results,
+        }, indent=2, sort_keys=True) + '\n')
+
+    def cleanup(self):
+        Poll.objects.filter(slug__startswith=SLUG_PREFIX).delete()
+        SimpleModel.objects.filter(slug__startswith=SLUG_PREFIX).delete()
+
+    def run_votes(self, params, rng, polls, choices):
+        def cast():
+            for poll in polls:
+                poll.cast_votes([(None, fake_ip(n), rng.choice(choices[poll.pk]))
+                    for n in range(params['votes'])])
+        self.measure('cast_votes', cast)
+
+        poll = polls[0]
+        single = max(params['votes'] // 10, 1)
+        def vote():
+            for n in range(single):
+                poll.vote(None, rng.choice(choices[poll.pk]), voter_ip=fake_ip(params['votes'] + n))
+        self.measure('vote', vote)
+
+        def validate():
+            for n in range(single):
+                PollChoiceVote(poll=poll, choice=choices[poll.pk][0], voter_ip=fake_ip(params['votes'] + single + n)).validate_unique()
+        self.measure('validate_unique', validate)
+
+    def run(self, params, rng):
+        objects = [SimpleModel(name='Bench %d' % i, slug='%s%d' % (SLUG_PREFIX, i))
+            for i in range(params['objects'])]
+        SimpleModel.objects.bulk_create(objects)
+        objects = list(SimpleModel.objects.filter(slug__startswith=SLUG_PREFIX).order_by('pk'))
+        polls = [Poll.objects.create(title='Bench %d' % i, slug='%s%d' % (SLUG_PREFIX, i))
+            for i in range(params['polls'])]
+
+        def attach():
+            for poll in polls:
+                SimpleModel.polls.bulk_add(rng.sample(objects, min(params['choices'], len(objects))), [poll])
+        self.measure('manager.bulk_add', attach)
+        if not objects or not polls:
+            return
+        choices = dict((poll.pk, list(poll.choices())) for poll in polls)
+        poll = polls[0]
+        # with --choices 0 there is nothing to vote for, the reads still run
+        if choices[poll.pk]:
+            self.run_votes(params, rng, polls, choices)
+
+        self.measure('choices', poll.choices)
+        self.measure('choices_objects', poll.choices_objects)
+        self.measure('votes', poll.votes)
+        self.measure('tally', poll.tally)
+        self.measure('standings', poll.standings)
+        self.measure('prefetch_results', Poll.prefetch_results, Poll.objects.filter(pk__in=[p.pk for p in polls]))
+        self.measure('choices_for', lambda: list(PollChoice.choices_for(SimpleModel)))
+        self.measure('choices_for.instance', lambda: list(PollChoice.choices_for(SimpleModel, objects[0])))
+
+        obj = objects[0]
+        self.measure('manager.add', obj.polls.add, *polls)
+        self.measure('manager.set', obj.polls.set, *polls[:len(polls) // 2])
+        self.measure('manager.clear', obj.polls.clear)
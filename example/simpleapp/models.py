@@ -1,5 +1,6 @@
 from django.db import models
-from pollup.models import PollBase, ChoiceBase
+from pollup.models import (PollBase, ChoiceBase, RankedPollMixin, ApprovalPollMixin,
+    ScorePollMixin, OneVotePerUserMixin)
 from pollup.managers import PollableManager
 
 class CustomPoll(PollBase):
@@ -9,6 +10,32 @@ class CustomChoice(ChoiceBase):
     poll = models.ForeignKey(CustomPoll, related_name="choices")
     content_object = models.ForeignKey('SimpleModel', related_name="choices")
 
+class RankedPoll(PollBase, RankedPollMixin):
+    pass
+
+class RankedChoice(ChoiceBase):
+    poll = models.ForeignKey(RankedPoll, related_name="ranked_choices")
+    content_object = models.ForeignKey('SimpleModel', related_name="ranked_poll_choices")
+
+class ApprovalPoll(PollBase, ApprovalPollMixin, OneVotePerUserMixin):
+    pass
+
+class ApprovalChoice(ChoiceBase):
+    poll = models.ForeignKey(ApprovalPoll, related_name="approval_choices")
+    content_object = models.ForeignKey('SimpleModel', related_name="approval_poll_choices")
+
+class WriteInChoice(ChoiceBase):
+    # a second choice model, so the poll has two vote tables
+    poll = models.ForeignKey(ApprovalPoll, related_name="write_in_choices")
+    content_object = models.ForeignKey('SimpleModel', related_name="write_in_poll_choices")
+
+class ScorePoll(PollBase, ScorePollMixin, OneVotePerUserMixin):
+    pass
+
+class ScoreChoice(ChoiceBase):
+    poll = models.ForeignKey(ScorePoll, related_name="score_choices")
+    content_object = models.ForeignKey('SimpleModel', related_name="score_poll_choices")
+
 class SimpleModel(models.Model):
     """
     (SimpleModel description)
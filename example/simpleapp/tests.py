@@ -0,0 +1,206 @@
+import json
+import os
+import tempfile
+from StringIO import StringIO
+
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.core.urlresolvers import reverse
+from django.test import TestCase
+
+from pollup import stats
+from pollup.models import Poll, PollChoice, choice_token
+from pollup.lookups import clear_lookups
+
+from .models import (SimpleModel, RankedPoll, RankedChoice, RankedChoiceVote, ApprovalPoll,
+    ApprovalChoice, ApprovalChoiceVote, WriteInChoice, WriteInChoiceVote, ScorePoll, ScoreChoice)
+
+
+class PollableManagerTest(TestCase):
+    def setUp(self):
+        self.polls = [Poll.objects.create(title="Poll %d" % i, slug="poll-%d" % i) for i in range(3)]
+        self.obj = SimpleModel.objects.create(name="Thing", slug="thing")
+
+    def test_add(self):
+        self.obj.polls.add(self.polls[0])
+        with self.assertNumQueries(2):
+            self.obj.polls.add(self.polls[0], self.polls[1], self.polls[1])
+        with self.assertNumQueries(1):
+            self.obj.polls.add(self.polls[0])
+        self.assertEqual(PollChoice.objects.count(), 2)
+        self.assertEqual(set(self.obj.polls.all()), set(self.polls[:2]))
+
+    def test_set(self):
+        self.obj.polls.add(self.polls[0], self.polls[1])
+        kept = PollChoice.objects.get(poll=self.polls[1])
+        self.obj.polls.set(self.polls[1], self.polls[2])
+        self.assertEqual(set(self.obj.polls.all()), set(self.polls[1:]))
+        # unchanged rows are left alone
+        self.assertTrue(PollChoice.objects.filter(pk=kept.pk).exists())
+        self.obj.polls.set()
+        self.assertEqual(list(self.obj.polls.all()), [])
+
+    def test_remove_and_clear(self):
+        self.obj.polls.add(*self.polls)
+        self.obj.polls.remove(self.polls[0])
+        self.assertEqual(set(self.obj.polls.all()), set(self.polls[1:]))
+        self.obj.polls.clear()
+        self.assertEqual(PollChoice.objects.count(), 0)
+
+    def test_bulk_add_and_remove(self):
+        objs = [self.obj] + [SimpleModel.objects.create(name="Thing %d" % i, slug="thing-%d" % i) for i in range(4)]
+        self.obj.polls.add(self.polls[0])
+        with self.assertNumQueries(2):
+            SimpleModel.polls.bulk_add(objs, self.polls[:2])
+        self.assertEqual(PollChoice.objects.count(), 10)
+        self.assertEqual(set(objs[3].polls.all()), set(self.polls[:2]))
+
+        SimpleModel.polls.bulk_remove(objs[:2], [self.polls[0]])
+        self.assertEqual(list(self.obj.polls.all()), [self.polls[1]])
+        SimpleModel.polls.bulk_remove(objs[3:])
+        self.assertEqual(list(objs[4].polls.all()), [])
+        self.assertEqual(PollChoice.objects.count(), 4)
+
+    def test_bulk_add_duplicates(self):
+        other = SimpleModel.objects.create(name="Other", slug="other")
+        with self.assertNumQueries(2):
+            SimpleModel.polls.bulk_add([self.obj, other, self.obj], self.polls[:1])
+        self.assertEqual(PollChoice.objects.count(), 2)
+
+    def test_vote_for_added_choices(self):
+        clear_lookups()
+        others = [SimpleModel.objects.create(name="Other %d" % i, slug="other-%d" % i) for i in range(2)]
+        url = reverse('pollup_vote', kwargs={'slug': self.polls[0].slug})
+        self.obj.polls.add(self.polls[0])
+        choice = PollChoice.objects.get(poll=self.polls[0], object_id=self.obj.pk)
+        self.assertEqual(self.client.post(url, {'choice': choice_token(choice)}).status_code, 302)
+        # the view's cached choices of the poll go with the bulk inserts
+        others[0].polls.add(self.polls[0])
+        SimpleModel.polls.bulk_add(others[1:], self.polls[:1])
+        for ip, obj in zip(['10.0.0.1', '10.0.0.2'], others):
+            choice = PollChoice.objects.get(poll=self.polls[0], object_id=obj.pk)
+            response = self.client.post(url, {'choice': choice_token(choice)}, REMOTE_ADDR=ip)
+            self.assertEqual(response.status_code, 302)
+
+    def test_bulk_mixed_and_empty(self):
+        with self.assertNumQueries(0):
+            SimpleModel.polls.bulk_add([], self.polls)
+            SimpleModel.polls.bulk_add([self.obj], [])
+        # content objects of different models are grouped by content type
+        SimpleModel.polls.bulk_add([self.obj, self.polls[2]], [self.polls[0]])
+        self.assertEqual(PollChoice.objects.filter(poll=self.polls[0]).count(), 2)
+        self.assertEqual(list(self.obj.polls.all()), [self.polls[0]])
+
+
+class RankedPollTest(TestCase):
+    def test_instant_runoff(self):
+        poll = RankedPoll.objects.create(title="Ranked", slug="ranked")
+        a, b, c = [SimpleModel.objects.create(name=name, slug=name) for name in "abc"]
+        choices = [RankedChoice.objects.create(poll=poll, content_object=obj) for obj in (a, b, c)]
+        for ranking in [[a]] * 4 + [[b, c]] * 3 + [[c, b]] * 2:
+            poll.cast_ballot(None, ranking)
+        vote = RankedChoiceVote.objects.filter(choice=choices[2])[0]
+        self.assertEqual(vote.get_ranking(), [choices[2].pk, choices[1].pk])
+        with self.assertNumQueries(2):
+            result = poll.instant_runoff()
+        self.assertEqual(result.winner, choices[1].pk)
+        self.assertEqual(result.eliminated, [choices[2].pk])
+        self.assertEqual(poll.winner, choices[0])  # most first preferences
+
+    def test_ballot_checks(self):
+        poll = RankedPoll.objects.create(title="Ranked", slug="ranked")
+        a, b = [RankedChoice.objects.create(poll=poll, content_object=SimpleModel.objects.create(
+            name=name, slug=name)) for name in "ab"]
+        vote = poll.cast_ballot(None, [a, a, b, a])
+        self.assertEqual(vote.ballot, '%s,%s' % (a.pk, b.pk))
+        # ballot pks only name choices within one choice model
+        other = ScoreChoice(pk=b.pk, poll_id=poll.pk)
+        self.assertRaises(ValidationError, poll.cast_ballot, None, [a, other], voter_ip='10.0.0.1')
+
+
+class ApprovalAndScorePollTest(TestCase):
+    def setUp(self):
+        self.objs = [SimpleModel.objects.create(name=name, slug=name) for name in "abc"]
+        self.voters = [User.objects.create(username="voter%d" % i) for i in range(3)]
+
+    def test_approval(self):
+        poll = ApprovalPoll.objects.create(title="Approval", slug="approval")
+        a, b, c = [ApprovalChoice.objects.create(poll=poll, content_object=obj) for obj in self.objs]
+        poll.cast_approval(self.voters[0], [a, b, a])
+        poll.cast_approval(self.voters[1], self.objs[1:])
+        self.assertRaises(ValidationError, poll.cast_approval, self.voters[0], [c])
+        self.assertEqual(poll.approvals(), {(ApprovalChoice, a.pk): 1, (ApprovalChoice, b.pk): 2,
+            (ApprovalChoice, c.pk): 1})
+        self.assertEqual(poll.winner, b)
+
+    def test_export_import_ballots(self):
+        poll = ApprovalPoll.objects.create(title="Approval", slug="approval")
+        choices = [ApprovalChoice.objects.create(poll=poll, content_object=obj) for obj in self.objs]
+        poll.cast_approval(self.voters[0], choices)
+        fd, path = tempfile.mkstemp(suffix='.csv')
+        os.close(fd)
+        try:
+            call_command('pollup_export', 'simpleapp.approvalpoll', output=path, verbosity=0)
+            ApprovalChoiceVote.objects.all().delete()
+            out = StringIO()
+            call_command('pollup_import', path, stdout=out)
+            self.assertTrue(out.getvalue().startswith('3 rows read, 3 votes imported, 0 rejected'))
+        finally:
+            os.remove(path)
+        self.assertEqual(ApprovalChoiceVote.objects.exclude(dedup_key=None).count(), 1)
+        self.assertRaises(ValidationError, poll.cast_approval, self.voters[0], choices[:1])
+
+    def test_scores(self):
+        poll = ScorePoll.objects.create(title="Score", slug="score")
+        a, b, c = [ScoreChoice.objects.create(poll=poll, content_object=obj) for obj in self.objs]
+        poll.cast_scores(self.voters[0], [(a, 2), (b, 9)])
+        poll.cast_scores(self.voters[1], [(a, 4), (b, 7), (c, 10)])
+        self.assertRaises(ValidationError, poll.cast_scores, self.voters[2], [(a, 1), (a, 2)])
+        self.assertRaises(ValidationError, poll.cast_scores, self.voters[1], [(c, 1)])
+        with self.assertNumQueries(1):
+            totals = poll.score_totals()
+        self.assertEqual(totals[(ScoreChoice, b.pk)], {'count': 2, 'total': 16, 'mean': 8})
+        self.assertEqual(poll.score_standings(), [b, c, a])
+
+        if stats.numpy is not None:
+            distribution = stats.score_distribution(poll, bins=4)
+            self.assertEqual(distribution[(ScoreChoice, a.pk)]['mean'], 3)
+            low, high = distribution[(ScoreChoice, a.pk)]['ci']
+            self.assertTrue(low < 3 < high)
+            self.assertEqual(list(distribution[(ScoreChoice, c.pk)]['histogram'][0]), [0, 0, 0, 1])
+
+    def test_one_vote_across_vote_models(self):
+        poll = ApprovalPoll.objects.create(title="Approval", slug="approval")
+        a = ApprovalChoice.objects.create(poll=poll, content_object=self.objs[0])
+        write_in = WriteInChoice.objects.create(poll=poll, content_object=self.objs[1])
+        poll.vote(self.voters[0], write_in)
+        self.assertRaises(ValidationError, poll.vote, self.voters[0], a)
+        self.assertRaises(ValidationError, poll.cast_approval, self.voters[0], [a])
+        poll.cast_approval(self.voters[1], [a, write_in])
+        with self.assertNumQueries(1):
+            taken = poll.existing_vote_dedup_keys([poll.vote_dedup_key(voter, '') for voter in self.voters])
+        self.assertEqual(len(taken), 2)
+        self.assertEqual(poll.tally(), {(ApprovalChoice, a.pk): 1, (WriteInChoice, write_in.pk): 2})
+        # deleting the vote frees the voter again
+        WriteInChoiceVote.objects.filter(voter=self.voters[0]).delete()
+        poll.vote(self.voters[0], a)
+
+
+class BenchmarkCommandTest(TestCase):
+    def test_benchmark(self):
+        out = StringIO()
+        call_command('pollup_benchmark', polls=2, choices=3, votes=20, objects=5, stdout=out)
+        report = json.loads(out.getvalue())
+        self.assertEqual(report['params']['votes'], 20)
+        self.assertEqual(report['results']['tally']['queries'], 1)
+        self.assertTrue('manager.clear' in report['results'])
+        self.assertEqual(Poll.objects.count(), 0)
+        self.assertEqual(SimpleModel.objects.count(), 0)
+
+        # no choices: nothing to vote for, the reads are still timed
+        out = StringIO()
+        call_command('pollup_benchmark', polls=1, choices=0, votes=20, objects=5, stdout=out)
+        report = json.loads(out.getvalue())
+        self.assertFalse('cast_votes' in report['results'])
+        self.assertEqual(report['results']['tally']['queries'], 1)
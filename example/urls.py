@@ -10,6 +10,7 @@ urlpatterns = patterns('',
     # url(r'^example/', include('example.foo.urls')),
 
     url(r'^admin/', include(admin.site.urls)),
+    url(r'^polls/', include('pollup.urls')),
     # Uncomment the admin/doc line below to enable admin documentation:
     # url(r'^admin/doc/', include('django.contrib.admindocs.urls')),
 )
@@ -17,5 +18,5 @@ urlpatterns = patterns('',
 urlpatterns = urlpatterns + patterns('',
     (r'^static/(?P<path>.*)$', 'django.views.static.serve',
         {'document_root': settings.MEDIA_ROOT}),
-    ) if settings.DEBUG else urlpatterson
+    ) if settings.DEBUG else urlpatterns
 
@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Non-blocking poll API.
+
+``PollBase.avote()``, ``atally()`` and ``achoices()`` hand their work to the
+process wide ``Batcher`` and return a ``PendingResult`` right away. A worker
+thread waits ``BATCH_DELAY`` seconds for more calls to arrive, then runs them:
+the votes queued for a poll are written with a single ``cast_votes()`` call.
+An event loop (Twisted, Tornado, gevent...) can poll ``done()`` or hook
+``add_done_callback()`` instead of blocking on the database.
+"""
+import logging
+import threading
+import time
+
+from django.core.exceptions import ValidationError
+from django.db import connection
+
+from pollup import settings
+
+logger = logging.getLogger('pollup')
+
+
+class PendingResult(object):
+    """
+    Result of a batched call, after concurrent.futures.Future.
+    """
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self._result = None
+        self._exception = None
+
+    def done(self):
+        return self._event.is_set()
+
+    def result(self, timeout=None):
+        # wait for the call, raising what it raised
+        if not self._event.wait(timeout):
+            raise RuntimeError(u"Result not ready")
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self, timeout=None):
+        if not self._event.wait(timeout):
+            raise RuntimeError(u"Result not ready")
+        return self._exception
+
+    def add_done_callback(self, fn):
+        # fn(pending) runs on the worker thread, or now if already done
+        with self._lock:
+            if not self.done():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def set_result(self, result):
+        self._result = result
+        self._finish()
+
+    def set_exception(self, exception):
+        self._exception = exception
+        self._finish()
+
+    def _finish(self):
+        with self._lock:
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception:
+                logger.exception(u"PendingResult callback failed")
+
+
+class Batcher(object):
+    def __init__(self, delay=None, threaded=True):
+        self.delay = delay if delay is not None else settings.BATCH_DELAY
+        self.threaded = threaded
+        self.condition = threading.Condition()
+        self.queue = []
+        self._thread = None
+
+    def __len__(self):
+        return len(self.queue)
+
+    def vote(self, poll, voter, choice_object, voter_ip=''):
+        return self._submit(('vote', poll, (voter, voter_ip, choice_object)))
+
+    def call(self, fn, *args, **kwargs):
+        return self._submit(('call', fn, (args, kwargs)))
+
+    def _submit(self, job):
+        pending = PendingResult()
+        with self.condition:
+            self.queue.append(job + (pending,))
+            self.condition.notify()
+        self._ensure_thread()
+        return pending
+
+    def flush(self):
+        """
+        Run everything queued so far on the calling thread. Returns the
+        number of calls run.
+        """
+        with self.condition:
+            jobs, self.queue = self.queue, []
+        # (poll class, poll pk) -> [poll, [(row, pending), ...]], in queue order
+        ballots = {}
+        order = []
+        for kind, target, args, pending in jobs:
+            if kind == 'call':
+                self._run(pending, target, *args[0], **args[1])
+                continue
+            poll_key = (target.__class__, target.pk)
+            if poll_key not in ballots:
+                ballots[poll_key] = [target, []]
+                order.append(poll_key)
+            ballots[poll_key][1].append((args, pending))
+        for poll_key in order:
+            self._cast(*ballots[poll_key])
+        return len(jobs)
+
+    def _run(self, pending, fn, *args, **kwargs):
+        try:
+            result = fn(*args, **kwargs)
+        except Exception, e:
+            pending.set_exception(e)
+        else:
+            pending.set_result(result)
+
+    def _cast(self, poll, entries):
+        rows = []
+        for (voter, voter_ip, choice_object), pending in entries:
+            try:
+                rows.append(((voter, voter_ip, poll.get_choice(choice_object)), pending))
+            except Exception, e:
+                pending.set_exception(e)
+        if not rows:
+            return
+        try:
+            accepted, rejected = poll.cast_votes([row for row, pending in rows])
+        except Exception, e:
+            for row, pending in rows:
+                pending.set_exception(e)
+            return
+        refused = dict((id(row), reason) for row, reason in rejected)
+        votes = iter(accepted)
+        for row, pending in rows:
+            if id(row) in refused:
+                pending.set_exception(ValidationError(refused[id(row)]))
+            else:
+                pending.set_result(votes.next())
+
+    def _ensure_thread(self):
+        if self._thread is not None or not self.threaded:
+            return
+        with self.condition:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, name='pollup-batcher')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _loop(self):
+        while True:
+            with self.condition:
+                while not self.queue:
+                    self.condition.wait()
+            # let concurrent callers join the batch
+            time.sleep(self.delay)
+            try:
+                self.flush()
+            except Exception:
+                logger.exception(u"Running batched poll calls failed")
+            finally:
+                connection.close()
+
+
+_batcher = None
+_batcher_lock = threading.Lock()
+
+def get_batcher():
+    global _batcher
+    if _batcher is None:
+        with _batcher_lock:
+            if _batcher is None:
+                _batcher = Batcher()
+    return _batcher
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Write-behind vote buffer.
+
+With ``POLLUP_SETTINGS['VOTE_BUFFER']`` turned on, ``PollBase.vote()`` appends
+to the process wide buffer instead of inserting. The buffer is written with
+``PollBase.cast_votes()`` once it holds ``VOTE_BUFFER_SIZE`` votes, every
+``VOTE_BUFFER_INTERVAL`` seconds from a background thread, on ``flush()`` and
+at interpreter exit.
+"""
+import atexit
+import logging
+import threading
+
+from django.core.exceptions import ValidationError
+from django.utils.translation import ugettext as _
+
+from pollup import settings
+
+logger = logging.getLogger('pollup')
+
+
+class VoteBuffer(object):
+    def __init__(self, size=None, interval=None):
+        self.size = size or settings.VOTE_BUFFER_SIZE
+        self.interval = interval if interval is not None else settings.VOTE_BUFFER_INTERVAL
+        self.lock = threading.RLock()
+        self.flush_lock = threading.Lock()
+        self._thread = None
+        # votes taken out of pending by a flush that is still writing them
+        self.in_flight = {}
+        self._reset()
+
+    def _reset(self):
+        # (poll class, poll pk) -> [poll, [(voter, voter_ip, choice), ...], set of dedup keys]
+        self.pending = {}
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def add(self, poll, voter, voter_ip, choice):
+        dedup_key = getattr(poll, 'vote_dedup_key', None)
+        key = dedup_key(voter, voter_ip) if dedup_key is not None else None
+        # the stored votes are checked outside the lock, votes a flush writes
+        # meanwhile are still in in_flight or caught by cast_votes()
+        if key is not None and poll.existing_vote_dedup_keys([key]):
+            raise ValidationError(_(u"Vote with this Voter or Voter IP already exists"))
+        with self.lock:
+            entry = self.pending.setdefault((poll.__class__, poll.pk), [poll, [], set()])
+            taken = entry[2]
+            if key is not None:
+                in_flight = self.in_flight.get((poll.__class__, poll.pk))
+                if key in taken or (in_flight is not None and key in in_flight[2]):
+                    raise ValidationError(_(u"Vote with this Voter or Voter IP already exists"))
+                taken.add(key)
+            entry[1].append((voter, voter_ip, choice))
+            self.count += 1
+            full = self.count >= self.size
+        self._ensure_thread()
+        if full:
+            self.flush()
+
+    def flush(self):
+        # flushes are serialized so a vote can't be written by two of them
+        with self.flush_lock:
+            with self.lock:
+                remaining = self.in_flight = self.pending
+                self._reset()
+            written = 0
+            try:
+                for poll_key, (poll, votes, taken) in remaining.items():
+                    accepted, rejected = poll.cast_votes(votes)
+                    del remaining[poll_key]
+                    written += len(accepted)
+                    for row, reason in rejected:
+                        logger.warning(u"Dropped buffered vote %r for poll %s: %s", row, poll.pk, reason)
+            finally:
+                # keep whatever wasn't written for the next flush
+                self._requeue(remaining)
+            return written
+
+    def _requeue(self, pending):
+        with self.lock:
+            for poll_key, (poll, votes, taken) in pending.items():
+                entry = self.pending.setdefault(poll_key, [poll, [], set()])
+                entry[1][:0] = votes
+                entry[2].update(taken)
+                self.count += len(votes)
+            self.in_flight = {}
+
+    def _ensure_thread(self):
+        if self._thread is not None or not self.interval:
+            return
+        with self.lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='pollup-vote-buffer')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _run(self):
+        event = threading.Event()
+        while True:
+            event.wait(self.interval)
+            try:
+                self.flush()
+            except Exception:
+                logger.exception(u"Flushing the vote buffer failed")
+
+
+_vote_buffer = None
+_vote_buffer_lock = threading.Lock()
+
+def get_vote_buffer():
+    global _vote_buffer
+    if _vote_buffer is None:
+        with _vote_buffer_lock:
+            if _vote_buffer is None:
+                _vote_buffer = VoteBuffer()
+                atexit.register(_vote_buffer.flush)
+    return _vote_buffer
+
+def flush():
+    # write out the process wide buffer, if there is one
+    if _vote_buffer is None:
+        return 0
+    return _vote_buffer.flush()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Opt-in cache of poll results.
+
+Set ``POLLUP_SETTINGS['RESULTS_CACHE']`` to a cache alias from ``CACHES`` (or
+anything ``get_cache`` accepts) to keep ``PollBase.results()`` in that cache.
+Entries are keyed by poll model and pk and are dropped whenever a vote or a
+choice of the poll is written or deleted.
+
+``POLLUP_SETTINGS['FRAGMENT_CACHE']`` does the same for the fragments the
+template tags render. Their keys carry a per-poll version that moves on to
+the time of the poll's latest vote or choice change, so stale fragments are
+never read and simply expire.
+"""
+import time
+
+from django.core.cache import get_cache
+
+from pollup import settings
+
+_caches = {}
+
+def _get_cache(backend):
+    if not backend:
+        return None
+    if backend not in _caches:
+        _caches[backend] = get_cache(backend)
+    return _caches[backend]
+
+def get_results_cache():
+    return _get_cache(settings.RESULTS_CACHE)
+
+def get_fragment_cache():
+    return _get_cache(settings.FRAGMENT_CACHE)
+
+def results_cache_key(poll_model, poll_pk):
+    return 'pollup:results:%s.%s:%s' % (
+        poll_model._meta.app_label, poll_model._meta.module_name, poll_pk)
+
+def get_results(poll_model, poll_pk):
+    cache = get_results_cache()
+    if cache is None:
+        return None
+    return cache.get(results_cache_key(poll_model, poll_pk))
+
+def set_results(poll_model, poll_pk, results):
+    cache = get_results_cache()
+    if cache is not None:
+        cache.set(results_cache_key(poll_model, poll_pk), results, settings.RESULTS_CACHE_TIMEOUT)
+
+def invalidate_results(poll_model, *poll_pks):
+    cache = get_results_cache()
+    if cache is not None and poll_pks:
+        cache.delete_many([results_cache_key(poll_model, poll_pk) for poll_pk in poll_pks])
+    bump_poll_versions(poll_model, *poll_pks)
+
+def poll_version_key(poll_model, poll_pk):
+    return 'pollup:version:%s.%s:%s' % (
+        poll_model._meta.app_label, poll_model._meta.module_name, poll_pk)
+
+def poll_versions(poll_model, *poll_pks):
+    """
+    {poll pk: version} with one cache round trip. Polls without a version
+    yet, or whose version expired, get the current time.
+    """
+    cache = get_fragment_cache()
+    if cache is None:
+        return {}
+    keys = dict((poll_version_key(poll_model, poll_pk), poll_pk) for poll_pk in poll_pks)
+    found = cache.get_many(keys.keys())
+    versions = dict((keys[key], version) for key, version in found.items())
+    missing = dict((key, _new_version()) for key in keys if key not in found)
+    if missing:
+        cache.set_many(missing)
+        versions.update((keys[key], version) for key, version in missing.items())
+    return versions
+
+def bump_poll_versions(poll_model, *poll_pks):
+    cache = get_fragment_cache()
+    if cache is not None and poll_pks:
+        version = _new_version()
+        cache.set_many(dict((poll_version_key(poll_model, poll_pk), version) for poll_pk in poll_pks))
+
+def _new_version():
+    return '%x' % int(time.time() * 1000000)
+
+def fragment_key(name, *parts):
+    return 'pollup:fragment:%s:%s' % (name, ':'.join([str(part) for part in parts]))
+
+def get_fragment(key):
+    cache = get_fragment_cache()
+    if cache is None:
+        return None
+    return cache.get(key)
+
+def set_fragment(key, html):
+    cache = get_fragment_cache()
+    if cache is not None:
+        cache.set(key, html, settings.FRAGMENT_CACHE_TIMEOUT)
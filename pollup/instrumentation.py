@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Timing of pollup's hot paths.
+
+With ``POLLUP_SETTINGS['INSTRUMENTATION']`` on, every call to an
+``@instrumented`` function is timed and its queries counted. The numbers are
+sent with the ``hot_path_timed`` signal, logged to the ``pollup.instrumentation``
+logger at DEBUG level and added to in-memory totals read with ``get_stats()``.
+"""
+import logging
+import threading
+import time
+
+from django.conf import settings as site_settings
+from django.db import connection
+from django.dispatch import Signal
+from django.utils.functional import wraps
+
+from pollup import settings
+
+logger = logging.getLogger('pollup.instrumentation')
+
+hot_path_timed = Signal(providing_args=['path', 'duration', 'queries'])
+
+_stats = {}
+_stats_lock = threading.Lock()
+
+def get_stats():
+    # {path: {'calls': n, 'time': seconds, 'queries': n}}
+    with _stats_lock:
+        return dict((path, dict(totals)) for path, totals in _stats.items())
+
+def reset_stats():
+    with _stats_lock:
+        _stats.clear()
+
+def record(path, duration, queries):
+    with _stats_lock:
+        totals = _stats.setdefault(path, {'calls': 0, 'time': 0.0, 'queries': 0})
+        totals['calls'] += 1
+        totals['time'] += duration
+        totals['queries'] += queries
+    logger.debug(u"%s took %.6fs and %d queries", path, duration, queries)
+    hot_path_timed.send(sender=None, path=path, duration=duration, queries=queries)
+
+def instrumented(path):
+    def decorator(func):
+        @wraps(func)
+        def inner(*args, **kwargs):
+            if not settings.INSTRUMENTATION:
+                return func(*args, **kwargs)
+            # queries are only recorded by the debug cursor
+            use_debug_cursor = connection.use_debug_cursor
+            recording = use_debug_cursor or (use_debug_cursor is None and site_settings.DEBUG)
+            connection.use_debug_cursor = True
+            queries_before = len(connection.queries)
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                duration = time.time() - start
+                queries = len(connection.queries) - queries_before
+                connection.use_debug_cursor = use_debug_cursor
+                if not recording:
+                    # only request_started resets the list, and worker threads
+                    # and commands never see one
+                    del connection.queries[queries_before:]
+                record(path, duration, queries)
+        return inner
+    return decorator
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+In-process maps the views resolve polls and choices with.
+
+The polls looked up by slug and each poll's choice ids are loaded once and kept
+for ``LOOKUP_CACHE_TIMEOUT`` seconds. Saving or deleting a poll or choice clears
+its entries (ChoiceMetaClass connects the receivers per model); writes that
+send no signals, like the pollable managers' bulk_create, call
+``clear_choice_lookups()`` themselves.
+"""
+import threading
+import time
+
+from django.core.exceptions import ValidationError
+from django.http import Http404
+from django.utils.translation import ugettext as _
+
+from pollup import settings
+
+# poll model -> {slug: (expires, field values)}, poll model -> {poll pk: (expires, {(ct pk, choice pk): choice model})}
+_polls_by_slug = {}
+_poll_choices = {}
+_lookups_lock = threading.Lock()
+
+
+def lookup_poll(poll_model, slug):
+    """
+    A new instance of the poll with ``slug``, built from its field values
+    as cached in process for LOOKUP_CACHE_TIMEOUT seconds or until the poll
+    changes. Each caller gets its own instance to set attributes on.
+    """
+    now = time.time()
+    attnames = [field.attname for field in poll_model._meta.fields]
+    cached = _polls_by_slug.get(poll_model, {}).get(slug)
+    if cached is None or cached[0] <= now:
+        rows = list(poll_model._default_manager.filter(slug=slug).values_list(*attnames)[:1])
+        if not rows:
+            raise Http404
+        with _lookups_lock:
+            cached = _polls_by_slug.setdefault(poll_model, {})[slug] = (
+                now + settings.LOOKUP_CACHE_TIMEOUT, rows[0])
+    poll = poll_model(**dict(zip(attnames, cached[1])))
+    poll._state.adding = False
+    poll._state.db = poll_model._default_manager.db
+    return poll
+
+def lookup_choice(poll, token):
+    """
+    An unsaved stand-in for the choice ``token`` names, checked against the
+    cached set of the poll's choices without loading the choice.
+    """
+    from pollup.models import get_content_type, parse_choice_token
+    now = time.time()
+    cached = _poll_choices.get(poll.__class__, {}).get(poll.pk)
+    if cached is None or cached[0] <= now:
+        choices = {}
+        for choice_model in poll.choices_models():
+            content_type_id = get_content_type(choice_model).pk
+            for pk in choice_model._default_manager.filter(poll=poll).values_list('pk', flat=True):
+                choices[(content_type_id, pk)] = choice_model
+        with _lookups_lock:
+            cached = _poll_choices.setdefault(poll.__class__, {})[poll.pk] = (
+                now + settings.LOOKUP_CACHE_TIMEOUT, choices)
+    try:
+        key = parse_choice_token(token)
+        choice_model = cached[1][key]
+    except (ValueError, KeyError):
+        raise ValidationError(_(u"Choice is not part of this poll"))
+    return choice_model(pk=key[1], poll_id=poll.pk)
+
+def clear_lookups():
+    with _lookups_lock:
+        _polls_by_slug.clear()
+        _poll_choices.clear()
+
+def clear_poll_lookups(poll_model, *poll_pks):
+    # a poll was saved or deleted, its slug may have changed
+    with _lookups_lock:
+        _polls_by_slug.pop(poll_model, None)
+        choices = _poll_choices.get(poll_model, {})
+        for poll_pk in poll_pks:
+            choices.pop(poll_pk, None)
+
+def clear_choice_lookups(poll_model, *poll_pks):
+    with _lookups_lock:
+        choices = _poll_choices.get(poll_model, {})
+        for poll_pk in poll_pks:
+            choices.pop(poll_pk, None)
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import csv
+import json
+import sys
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import models
+
+from pollup.models import PollBase, resolve_content_objects, vote_models
+
+COLUMNS = ('vote_type', 'vote_id', 'poll_type', 'poll_id', 'choice_type', 'choice_id',
+    'voter_id', 'voter_ip', 'time_stamp', 'weight', 'ballot', 'dedup_key')
+OBJECT_COLUMNS = ('object_type', 'object_id', 'object')
+
+# vote fields read for the columns above, when the vote model has them
+VOTE_FIELDS = ('pk', 'poll', 'choice', 'voter', 'voter_ip', 'time_stamp', 'weight', 'ballot', 'dedup_key')
+
+
+def model_label(model):
+    return u'%s.%s' % (model._meta.app_label, model._meta.object_name.lower())
+
+def get_poll_model(label):
+    try:
+        app_label, model_name = label.split('.')
+    except ValueError:
+        raise CommandError("Polls are given as app_label.model[:pk], got %r" % label)
+    model = models.get_model(app_label, model_name)
+    if model is None or not issubclass(model, PollBase):
+        raise CommandError("%r is not a poll model" % label)
+    return model
+
+
+class Command(BaseCommand):
+    args = '[app_label.model[:pk] ...]'
+    help = ("Stream the votes of the given polls, or of all polls, as CSV or JSON lines. "
+        "Votes are read in primary key order one chunk at a time, so memory use stays flat.")
+    option_list = BaseCommand.option_list + (
+        make_option('--format', dest='format', default='csv', choices=('csv', 'jsonl'),
+            help='csv (default) or jsonl.'),
+        make_option('--output', dest='output', default=None,
+            help='File to write to, stdout by default.'),
+        make_option('--chunk-size', dest='chunk_size', type='int', default=2000,
+            help='Votes read per query.'),
+        make_option('--objects', dest='objects', action='store_true', default=False,
+            help="Add the choices' content objects, loaded once per chunk."),
+    )
+
+    def handle(self, *polls, **options):
+        targets = self.get_targets(polls)
+        output = open(options['output'], 'wb') if options['output'] else getattr(self, 'stdout', sys.stdout)
+        columns = COLUMNS + (OBJECT_COLUMNS if options['objects'] else ())
+        if options['format'] == 'csv':
+            writer = csv.writer(output)
+            writer.writerow(columns)
+            write = lambda row: writer.writerow([self.csv_value(row[column]) for column in columns])
+        else:
+            write = lambda row: output.write(json.dumps(row, default=unicode) + '\n')
+        exported = 0
+        try:
+            for vote_model, poll_ids in targets:
+                for row in self.rows(vote_model, poll_ids, options['chunk_size'], options['objects']):
+                    write(row)
+                    exported += 1
+        finally:
+            if options['output']:
+                output.close()
+        if options['output'] and int(options.get('verbosity', 1)) > 0:
+            self.stdout.write("%d votes exported\n" % exported)
+
+    def get_targets(self, polls):
+        # [(vote model, poll pks or None for all polls), ...]
+        if not polls:
+            return [(vote_model, None) for vote_model in vote_models()]
+        wanted = {}
+        for label in polls:
+            label, _, pk = label.partition(':')
+            poll_model = get_poll_model(label)
+            for vote_model in poll_model.votes_models():
+                poll_ids = wanted.setdefault(vote_model, set())
+                if poll_ids is not None:
+                    if pk:
+                        poll_ids.add(int(pk))
+                    else:
+                        wanted[vote_model] = None
+        return [(vote_model, wanted[vote_model]) for vote_model in vote_models() if vote_model in wanted]
+
+    def rows(self, vote_model, poll_ids, chunk_size, objects):
+        """
+        Rows of ``vote_model`` as dicts, keyset paginated on the primary key.
+        """
+        field_names = vote_model._meta.get_all_field_names()
+        fields = [field for field in VOTE_FIELDS if field == 'pk' or field in field_names]
+        labels = {
+            'vote_type': model_label(vote_model),
+            'poll_type': model_label(vote_model.poll_model()),
+            'choice_type': model_label(vote_model.choice_model()),
+        }
+        qs = vote_model._default_manager.order_by('pk')
+        if poll_ids is not None:
+            qs = qs.filter(poll__in=poll_ids)
+        last_pk = 0
+        while True:
+            chunk = list(qs.filter(pk__gt=last_pk).values_list(*fields)[:chunk_size].iterator())
+            if not chunk:
+                return
+            last_pk = chunk[-1][0]
+            content_objects = self.content_objects(vote_model, chunk) if objects else {}
+            for values in chunk:
+                values = dict(zip(fields, values))
+                row = dict(labels, vote_id=values['pk'], poll_id=values['poll'],
+                    choice_id=values['choice'], voter_id=values.get('voter'),
+                    voter_ip=values.get('voter_ip', ''), time_stamp=values['time_stamp'].isoformat(),
+                    weight=values.get('weight'), ballot=values.get('ballot', ''),
+                    dedup_key=values.get('dedup_key'))
+                if objects:
+                    obj = content_objects.get(values['choice'])
+                    row.update(object_type=model_label(obj) if obj is not None else None,
+                        object_id=obj.pk if obj is not None else None,
+                        object=unicode(obj) if obj is not None else None)
+                yield row
+
+    def content_objects(self, vote_model, chunk):
+        # {choice pk: content object} for a chunk, one query per model involved
+        choice_ids = set(values[2] for values in chunk)
+        choices = vote_model.choice_model()._default_manager.in_bulk(choice_ids).values()
+        resolve_content_objects(choices)
+        return dict((choice.pk, choice.content_object) for choice in choices)
+
+    def csv_value(self, value):
+        if value is None:
+            return ''
+        if isinstance(value, unicode):
+            return value.encode('utf-8')
+        return value
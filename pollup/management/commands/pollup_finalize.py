@@ -0,0 +1,17 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand
+from django.db import models
+
+from pollup.models import ScheduledPollMixin
+
+
+class Command(BaseCommand):
+    help = "Finalize the results of scheduled polls whose voting has closed. Run it periodically, e.g. from cron."
+
+    def handle(self, **options):
+        for model in models.get_models():
+            if issubclass(model, ScheduledPollMixin):
+                finalized = model._default_manager.finalize_closed()
+                if int(options.get('verbosity', 1)) > 0:
+                    self.stdout.write("%s: %d polls finalized\n" % (model._meta.object_name, finalized))
@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import csv
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager
+from optparse import make_option
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import ObjectDoesNotExist
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction, IntegrityError
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.utils.translation import ugettext as _
+
+from pollup.cache import invalidate_results
+from pollup.models import GenericChoiceBase, ImportMark, get_content_type
+from pollup.management.commands.pollup_export import get_poll_model
+
+
+@contextmanager
+def keep_time_stamps(vote_models):
+    # bulk_create would stamp auto_now_add fields with the import time
+    fields = [vote_model._meta.get_field('time_stamp') for vote_model in vote_models]
+    for field in fields:
+        field.auto_now_add = False
+    try:
+        yield
+    finally:
+        for field in fields:
+            field.auto_now_add = True
+
+
+class Command(BaseCommand):
+    args = '<file or ->'
+    help = ("Load votes from CSV or JSON lines in the pollup_export format. Rows name their poll "
+        "with poll_type and poll_id, and their choice with choice_type and choice_id or with "
+        "the object_type and object_id the choice points to. The one-vote rules use the "
+        "dedup_key column when there is one, and the voter otherwise. Each chunk is written in one "
+        "transaction that also records how far the import got, so a rerun resumes there.")
+    option_list = BaseCommand.option_list + (
+        make_option('--format', dest='format', default=None, choices=('csv', 'jsonl'),
+            help='csv or jsonl, guessed from the file name by default.'),
+        make_option('--chunk-size', dest='chunk_size', type='int', default=2000,
+            help='Rows loaded per transaction.'),
+        make_option('--checkpoint', dest='checkpoint', default=None,
+            help='Name the progress is saved under, the file path by default. '
+                'Required to resume imports from stdin.'),
+    )
+
+    def handle(self, path=None, **options):
+        if path is None:
+            raise CommandError("Give a file to import, or - for stdin.")
+        self.verbosity = int(options.get('verbosity', 1))
+        fmt = options['format'] or ('jsonl' if path.endswith(('.jsonl', '.json')) else 'csv')
+        source = options['checkpoint'] or (os.path.abspath(path) if path != '-' else None)
+        self.content_types = {}
+        self.polls = {}
+        self.choices = {}
+
+        mark = None
+        if source is not None:
+            mark = ImportMark.objects.get_or_create(source=source)[0]
+        skip = mark.rows if mark is not None else 0
+
+        stream = sys.stdin if path == '-' else open(path, 'rb')
+        try:
+            if fmt == 'csv':
+                rows = csv.DictReader(stream)
+            else:
+                rows = (json.loads(line) for line in stream if line.strip())
+            self.load(rows, skip, mark, options['chunk_size'])
+        finally:
+            if path != '-':
+                stream.close()
+
+    def load(self, rows, skip, mark, chunk_size):
+        start = time.time()
+        read, imported, rejected = skip, 0, 0
+        chunk = []
+        for number, row in enumerate(rows, 1):
+            if number <= skip:
+                continue
+            chunk.append((number, row))
+            if len(chunk) >= chunk_size:
+                loaded = self.load_chunk(chunk, mark)
+                read, imported, rejected = number, imported + loaded, rejected + len(chunk) - loaded
+                chunk = []
+                self.report(read, imported, rejected, start, 2)
+        if chunk:
+            loaded = self.load_chunk(chunk, mark)
+            read, imported, rejected = chunk[-1][0], imported + loaded, rejected + len(chunk) - loaded
+        self.report(read, imported, rejected, start, 1)
+
+    def report(self, read, imported, rejected, start, verbosity):
+        if self.verbosity >= verbosity:
+            elapsed = time.time() - start
+            self.stdout.write("%d rows read, %d votes imported, %d rejected in %.1fs (%.0f votes/s)\n" % (
+                read, imported, rejected, elapsed, imported / elapsed if elapsed else 0))
+
+    def load_chunk(self, chunk, mark):
+        """
+        Check and insert one chunk of (row number, row) pairs. Returns the
+        number of votes inserted.
+        """
+        # poll -> [(row number, vote), ...]
+        ballots = {}
+        for number, row in chunk:
+            try:
+                poll, vote = self.build_vote(row)
+            except (ValueError, KeyError, LookupError, ObjectDoesNotExist), e:
+                self.reject(number, e)
+                continue
+            ballots.setdefault(poll, []).append((number, vote))
+
+        accepted = {}
+        for poll, votes in ballots.items():
+            accepted[poll] = self.check_votes(poll, votes)
+        vote_models = set(vote.__class__ for votes in accepted.values() for vote in votes)
+        try:
+            with keep_time_stamps(vote_models):
+                with transaction.commit_on_success():
+                    for poll, votes in accepted.items():
+                        poll._write_votes(votes)
+                    if mark is not None:
+                        mark.rows = chunk[-1][0]
+                        mark.save()
+        except IntegrityError:
+            raise CommandError("Rows %d to %d collided with votes written meanwhile and were rolled back, "
+                "rerun the import to resume." % (chunk[0][0], chunk[-1][0]))
+        for poll in accepted:
+            invalidate_results(poll.__class__, poll.pk)
+        return sum(len(votes) for votes in accepted.values())
+
+    def check_votes(self, poll, votes):
+        # the poll's one-vote rules, one query for the whole chunk
+        if getattr(poll, 'vote_dedup_key', None) is None:
+            return [vote for number, vote in votes]
+        taken = poll.existing_vote_dedup_keys([vote.dedup_key for number, vote in votes])
+        accepted = []
+        for number, vote in votes:
+            if vote.dedup_key is not None:
+                if vote.dedup_key in taken:
+                    self.reject(number, _(u"Vote with this Voter or Voter IP already exists"))
+                    continue
+                taken.add(vote.dedup_key)
+            accepted.append(vote)
+        return accepted
+
+    def reject(self, number, reason):
+        if self.verbosity >= 2:
+            self.stderr.write("Row %d rejected: %s\n" % (number, reason))
+
+    def build_vote(self, row):
+        poll = self.get_poll(row['poll_type'], int(row['poll_id']))
+        choice = self.get_choice(poll, row)
+        voter_id = row.get('voter_id')
+        vote = poll._new_vote(choice, voter_ip=row.get('voter_ip') or '')
+        if voter_id not in (None, ''):
+            vote.voter_id = int(voter_id)
+        if hasattr(vote, 'dedup_key'):
+            if 'dedup_key' in row:
+                # as exported; a ballot's rows after the first have none
+                vote.dedup_key = row['dedup_key'] or None
+            else:
+                vote.dedup_key = poll.vote_dedup_key(vote.voter_id, vote.voter_ip)
+        if row.get('time_stamp'):
+            vote.time_stamp = parse_datetime(row['time_stamp'])
+            if vote.time_stamp is None:
+                raise ValueError("Invalid time_stamp %r" % row['time_stamp'])
+        else:
+            vote.time_stamp = timezone.now()
+        if row.get('weight') not in (None, '') and hasattr(vote, 'weight'):
+            vote.weight = float(row['weight'])
+        if row.get('ballot') and hasattr(vote, 'ballot'):
+            vote.ballot = row['ballot']
+        return poll, vote
+
+    def get_content_type(self, label):
+        try:
+            return self.content_types[label]
+        except KeyError:
+            app_label, model = label.split('.')
+            ct = self.content_types[label] = ContentType.objects.get_by_natural_key(app_label, model)
+            return ct
+
+    def get_poll(self, label, pk):
+        try:
+            return self.polls[(label, pk)]
+        except KeyError:
+            poll_model = get_poll_model(label)
+            try:
+                poll = poll_model._default_manager.get(pk=pk)
+            except poll_model.DoesNotExist:
+                raise LookupError("No %s with pk %s" % (label, pk))
+            self.polls[(label, pk)] = poll
+            return poll
+
+    def get_choice(self, poll, row):
+        choices = self.choices.get(poll)
+        if choices is None:
+            choices = self.choices[poll] = self.map_choices(poll)
+        if row.get('choice_type') and row.get('choice_id') not in (None, ''):
+            key = ('choice', self.get_content_type(row['choice_type']).pk, int(row['choice_id']))
+        else:
+            key = ('object', self.get_content_type(row['object_type']).pk, int(row['object_id']))
+        try:
+            return choices[key]
+        except KeyError:
+            raise LookupError(_(u"Choice is not part of this poll"))
+
+    def map_choices(self, poll):
+        """
+        Every choice of ``poll`` keyed both by its own content type and pk and
+        by the content type and object id it points to, as lookup_kwargs
+        would match them.
+        """
+        choices = {}
+        for choice in poll.choices():
+            choices[('choice', get_content_type(choice).pk, choice.pk)] = choice
+            if isinstance(choice, GenericChoiceBase):
+                object_key = (choice.content_type_id, choice.object_id)
+            else:
+                field = choice._meta.get_field('content_object')
+                object_key = (get_content_type(field.rel.to).pk, getattr(choice, field.attname))
+            choices[('object',) + object_key] = choice
+        return choices
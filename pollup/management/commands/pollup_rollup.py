@@ -0,0 +1,24 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from pollup import settings
+from pollup.models import RollupMark, vote_models
+
+
+class Command(BaseCommand):
+    help = "Count votes cast since the last run into the VoteRollup trend buckets."
+    option_list = BaseCommand.option_list + (
+        make_option('--chunk-size', dest='chunk_size', type='int', default=1000,
+            help='Votes counted per transaction.'),
+    )
+
+    def handle(self, **options):
+        if settings.ROLLUP_ON_VOTE:
+            raise CommandError("ROLLUP_ON_VOTE is on, votes are already rolled up as they are written.")
+        for vote_model in vote_models():
+            processed = RollupMark.process(vote_model, chunk_size=options['chunk_size'])
+            if int(options.get('verbosity', 1)) > 0:
+                self.stdout.write("%s: %d new votes rolled up\n" % (vote_model._meta.object_name, processed))
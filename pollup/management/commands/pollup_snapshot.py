@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import models
+from django.utils import timezone
+
+from pollup.models import ResultSnapshot, ScheduledPollMixin, get_content_type
+
+
+class Command(BaseCommand):
+    help = ("Store result snapshots for closed polls that have none yet, such as polls closed "
+        "before snapshots existed, and mark them finalized.")
+    option_list = BaseCommand.option_list + (
+        make_option('--chunk-size', dest='chunk_size', type='int', default=200,
+            help='Polls snapshotted per batch.'),
+        make_option('--all', dest='all', action='store_true', default=False,
+            help='Retake the snapshots of polls that already have one.'),
+    )
+
+    def handle(self, **options):
+        for model in models.get_models():
+            if issubclass(model, ScheduledPollMixin):
+                taken = self.backfill(model, options['chunk_size'], options['all'])
+                if int(options.get('verbosity', 1)) > 0:
+                    self.stdout.write("%s: %d polls snapshotted\n" % (model._meta.object_name, taken))
+
+    def backfill(self, model, chunk_size, retake):
+        poll_type = get_content_type(model)
+        closed = model._default_manager.closed().order_by('pk')
+        taken, last_pk = 0, 0
+        while True:
+            polls = list(closed.filter(pk__gt=last_pk)[:chunk_size])
+            if not polls:
+                return taken
+            last_pk = polls[-1].pk
+            if not retake:
+                done = set(ResultSnapshot.objects.filter(poll_type=poll_type,
+                    poll_id__in=[poll.pk for poll in polls]).values_list('poll_id', flat=True))
+                polls = [poll for poll in polls if poll.pk not in done]
+            if not polls:
+                continue
+            ResultSnapshot.take(polls)
+            model._default_manager.filter(pk__in=[poll.pk for poll in polls],
+                finalized_on__isnull=True).update(finalized_on=timezone.now())
+            taken += len(polls)
@@ -1,6 +1,7 @@
 from django.contrib.contenttypes.generic import GenericRelation
 from django.contrib.contenttypes.models import ContentType
-from django.db import models
+from django.db import models, DEFAULT_DB_ALIAS
+from django.db.models.signals import post_syncdb, class_prepared
 from django.db.models.fields.related import ManyToManyRel, ManyToManyField, RelatedField, add_lazy_relation
 from django.db.models.related import RelatedObject
 from django.utils.text import capfirst
@@ -8,7 +9,10 @@ from django.utils.translation import ugettext_lazy as _
 
 from django import forms
 
-from pollup.models import PollChoice, GenericChoiceBase
+from pollup.cache import invalidate_results
+from pollup.instrumentation import instrumented
+from pollup.lookups import clear_choice_lookups
+from pollup.models import PollChoice, GenericChoiceBase, get_content_type
 
 try:
     all
@@ -128,14 +132,21 @@ class PollableManager(RelatedField):
     def formfield(self, **kwargs):
         return None
 
+    def bulk_related_objects(self, objs, using=DEFAULT_DB_ALIAS):
+        # lets the deletion collector cascade to the through rows
+        return self.through._base_manager.db_manager(using).filter(
+            **self.through.bulk_lookup_kwargs(objs))
+
     def extra_filters(self, pieces, pos, negate):
         if negate or not self.use_gfk:
             return []
         prefix = "__".join(["poll_choices"] + pieces[:pos-2])
-        cts = map(ContentType.objects.get_for_model, _get_subclasses(self.model))
-        if len(cts) == 1:
-            return [("%s__content_type" % prefix, cts[0])]
-        return [("%s__content_type__in" % prefix, cts)]
+        ct_ids = _get_subclass_content_type_ids(self.model)
+        if len(ct_ids) == 1:
+            return [("%s__content_type" % prefix, ct_ids[0])]
+        return [("%s__content_type__in" % prefix, ct_ids)]
+
+BULK_CHUNK_SIZE = 500
 
 class _PollableManager(models.Manager):
     def __init__(self, through, model, instance):
@@ -149,31 +160,129 @@ class _PollableManager(models.Manager):
     def _lookup_kwargs(self):
         return self.through.lookup_kwargs(self.instance)
 
+    def _existing_poll_ids(self, polls=None):
+        qs = self.through.objects.filter(**self._lookup_kwargs())
+        if polls is not None:
+            qs = qs.filter(poll__in=polls)
+        return set(qs.values_list('poll', flat=True))
+
+    def _add_poll_ids(self, poll_ids):
+        lookup_kwargs = self._lookup_kwargs()
+        self.through.objects.bulk_create([
+            self.through(poll_id=poll_id, **lookup_kwargs) for poll_id in poll_ids
+        ])
+        # bulk_create sends no post_save
+        invalidate_results(self.through.poll_model(), *poll_ids)
+        clear_choice_lookups(self.through.poll_model(), *poll_ids)
+
+    @instrumented('manager.add')
     @require_instance_manager
     def add(self, *polls):
-        for poll in polls:
-            self.through.objects.get_or_create(poll=poll, **self._lookup_kwargs())
+        poll_ids = set([getattr(poll, 'pk', poll) for poll in polls])
+        if poll_ids:
+            self._add_poll_ids(poll_ids - self._existing_poll_ids(poll_ids))
 
+    @instrumented('manager.set')
     @require_instance_manager
     def set(self, *polls):
-        self.clear()
-        self.add(*polls)
+        # only touch the through rows that actually change
+        poll_ids = set([getattr(poll, 'pk', poll) for poll in polls])
+        existing = self._existing_poll_ids()
+        if existing - poll_ids:
+            self.remove(*(existing - poll_ids))
+        self._add_poll_ids(poll_ids - existing)
+
+    def _chunks(self, instances):
+        # each object once, in chunks that keep IN lookups below the
+        # backend's parameter limits
+        seen = set()
+        unique = []
+        for instance in instances:
+            key = (get_content_type(instance).pk, instance.pk)
+            if key not in seen:
+                seen.add(key)
+                unique.append(instance)
+        for group in self.through.group_instances(unique):
+            for start in range(0, len(group), BULK_CHUNK_SIZE):
+                yield group[start:start + BULK_CHUNK_SIZE]
+
+    @instrumented('manager.bulk_add')
+    def bulk_add(self, instances, polls):
+        """
+        Attach every poll in ``polls`` to every object in ``instances``, with
+        one select and one insert per chunk of objects of the same model.
+        """
+        poll_ids = set([getattr(poll, 'pk', poll) for poll in polls])
+        if not poll_ids:
+            return
+        id_field = self.through.object_id_field_name()
+        for chunk in self._chunks(instances):
+            existing = set(self.through.objects.filter(poll__in=poll_ids,
+                **self.through.bulk_lookup_kwargs(chunk)).values_list(id_field, 'poll'))
+            self.through.objects.bulk_create([
+                self.through(poll_id=poll_id, **self.through.lookup_kwargs(instance))
+                for instance in chunk for poll_id in poll_ids
+                if (instance.pk, poll_id) not in existing
+            ])
+        invalidate_results(self.through.poll_model(), *poll_ids)
+        clear_choice_lookups(self.through.poll_model(), *poll_ids)
+
+    @instrumented('manager.bulk_remove')
+    def bulk_remove(self, instances, polls=None):
+        # detach polls, or all polls when None, from every object in instances
+        poll_ids = None
+        if polls is not None:
+            poll_ids = set([getattr(poll, 'pk', poll) for poll in polls])
+            if not poll_ids:
+                return
+        for chunk in self._chunks(instances):
+            qs = self.through.objects.filter(**self.through.bulk_lookup_kwargs(chunk))
+            if poll_ids is not None:
+                qs = qs.filter(poll__in=poll_ids)
+            qs.delete()
 
+    @instrumented('manager.remove')
     @require_instance_manager
     def remove(self, *polls):
         self.through.objects.filter(**self._lookup_kwargs()).filter(
             poll__in=list(polls)).delete()
 
+    @instrumented('manager.clear')
     @require_instance_manager
     def clear(self):
         self.through.objects.filter(**self._lookup_kwargs()).delete()
 
 
+_subclasses = {}
+_subclass_content_type_ids = {}
+
 def _get_subclasses(model):
+    try:
+        return _subclasses[model]
+    except KeyError:
+        pass
     subclasses = [model]
     for f in model._meta.get_all_field_names():
         field = model._meta.get_field_by_name(f)[0]
         if (isinstance(field, RelatedObject) and
             getattr(field.field.rel, "parent_link", None)):
             subclasses.extend(_get_subclasses(field.model))
-    return subclasses
\ No newline at end of file
+    _subclasses[model] = subclasses
+    return subclasses
+
+def _get_subclass_content_type_ids(model):
+    try:
+        return _subclass_content_type_ids[model]
+    except KeyError:
+        ct_ids = _subclass_content_type_ids[model] = [
+            get_content_type(subclass).pk for subclass in _get_subclasses(model)
+        ]
+        return ct_ids
+
+def _clear_subclass_cache(**kwargs):
+    # new models can add subclasses, a syncdb or flush can renumber content types
+    _subclasses.clear()
+    _subclass_content_type_ids.clear()
+
+post_syncdb.connect(_clear_subclass_cache, dispatch_uid='pollup_clear_subclasses')
+class_prepared.connect(_clear_subclass_cache, dispatch_uid='pollup_clear_subclasses')
\ No newline at end of file
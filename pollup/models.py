@@ -1,18 +1,30 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 import django
-from django.db import models
+from django.db import models, transaction, IntegrityError
+from django.db.models import Avg, Count, F, Q, Sum
+from django.db.models.signals import post_save, pre_delete, post_delete, post_syncdb, class_prepared
+from django.dispatch import Signal
 from django.core.exceptions import ValidationError
 from django.conf import settings as site_settings
+from django.utils import timezone
 from django.utils.translation import ugettext, ugettext_lazy as _
 
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes.generic import GenericForeignKey
 
 from pollup import settings
-from datetime import datetime
-
+from pollup.batching import get_batcher
+from pollup.buffer import get_vote_buffer
+from pollup.cache import get_results, set_results, invalidate_results
+from pollup.instrumentation import instrumented
+from pollup.lookups import clear_poll_lookups, clear_choice_lookups
+from pollup.registry import poll_relations, choice_relations, vote_relations, get_tables
+from pollup.tabulation import BallotBox, instant_runoff
 import sys
+import threading
+import time
+from contextlib import contextmanager
 
 if django.VERSION < (1, 5):
     from django.contrib.auth.models import User as UserModel
@@ -42,6 +54,19 @@ How to vote?
 
 """
 
+@contextmanager
+def _atomic():
+    # the caller's transaction if there is one, else one committed on success;
+    # commit_on_success alone would roll back the caller's work on a duplicate
+    if transaction.is_managed():
+        yield
+    else:
+        with transaction.commit_on_success():
+            yield
+
+# sent by ScheduledPollMixin.finalize() once a closed poll's results are frozen
+poll_finalized = Signal(providing_args=['poll'])
+
 class PollMetaClass(models.base.ModelBase):
     def __new__(cls, name, bases, attrs):
         bases_votebases = []
@@ -81,73 +106,361 @@ class PollBase(models.Model):
     def __unicode__(self):
         return self.title
 
-    def vote(self,voter,choice_object):
-        pass
-
-    @classmethod
-    def _populate_poll_reverse_helpers(cls):
-        cls._meta.poll_reverse_field_names = {'choices': [], 'votes': []}
-        cls._meta.poll_reverse_models = {'choices': [], 'votes': []}
-        for rel in cls._meta.get_all_related_objects():
-            if type(rel.field)==models.ForeignKey:
-                if issubclass(rel.field.model,ChoiceBase):
-                    key = 'choices'
-                elif issubclass(rel.field.model,cls.VoteBase):
-                    key = 'votes'
-                else:
-                    key = None
-
-                if key is not None:
-                    cls._meta.poll_reverse_field_names[key].append(rel.get_accessor_name())
-                    cls._meta.poll_reverse_models[key].append(rel.field.model)
+    def vote(self, voter, choice_object, voter_ip=''):
+        """
+        Vote for ``choice_object``, either a choice of this poll or the object
+        it points to. Returns the saved vote, or None when the vote went to
+        the write-behind buffer.
+        """
+        self.check_voting_open()
+        choice = self.get_choice(choice_object)
+        if settings.VOTE_BUFFER:
+            get_vote_buffer().add(self, voter, voter_ip, choice)
+            return None
+        return self._save_vote(self._new_vote(choice, voter, voter_ip))
+
+    def avote(self, voter, choice_object, voter_ip=''):
+        """
+        Non-blocking vote(). Returns a PendingResult for the vote; votes
+        submitted together are written with one cast_votes() call.
+        """
+        return get_batcher().vote(self, voter, choice_object, voter_ip)
+
+    def atally(self):
+        # PendingResult for tally()
+        return get_batcher().call(self.tally)
+
+    def achoices(self):
+        # PendingResult for choices()
+        return get_batcher().call(self.choices)
+
+    def check_voting_open(self):
+        # scheduled polls refuse votes outside their window, from the loaded fields
+        is_open = getattr(self, 'is_open', None)
+        if is_open is not None and not is_open():
+            raise ValidationError(_(u"Voting is not open for this poll"))
+
+    def get_choice(self, choice_object):
+        if isinstance(choice_object, ChoiceBase):
+            if choice_object.poll_id != self.pk:
+                raise ValidationError(_(u"Choice is not part of this poll"))
+            return choice_object
+        for choice_model in self.choices_models():
+            try:
+                return choice_model._default_manager.get(poll=self, **choice_model.lookup_kwargs(choice_object))
+            except choice_model.DoesNotExist:
+                pass
+        raise ValidationError(_(u"Choice is not part of this poll"))
+
+    def _new_vote(self, choice, voter=None, voter_ip=''):
+        vote = choice.vote_model()(poll=self, choice=choice)
+        field_names = vote._meta.get_all_field_names()
+        if 'voter' in field_names:
+            vote.voter = voter
+        if 'voter_ip' in field_names:
+            vote.voter_ip = voter_ip
+        if 'dedup_key' in field_names:
+            vote.dedup_key = self.vote_dedup_key(voter, voter_ip)
+        return vote
+
+    def _new_ballot(self, choices, voter=None, voter_ip=''):
+        # one vote per choice; only the first holds the dedup key so the
+        # one-vote rules count the ballot once
+        votes = [self._new_vote(choice, voter, voter_ip) for choice in choices]
+        for vote in votes[1:]:
+            if hasattr(vote, 'dedup_key'):
+                vote.dedup_key = None
+        return votes
 
-    @classmethod
-    def _check_poll_reverse_helpers(cls):
-        if hasattr(cls._meta,'poll_reverse_field_names') and hasattr(cls._meta,'poll_reverse_models'):
-            return
-        else:
-            cls._populate_poll_reverse_helpers()
+    def cast_votes(self, votes, batch_size=None):
+        """
+        Bulk vote path. ``votes`` is an iterable of (voter, voter_ip, choice)
+        tuples. Returns (accepted, rejected) where accepted are the inserted
+        vote instances and rejected are (input, reason) pairs.
+        """
+        votes = list(votes)
+        try:
+            self.check_voting_open()
+        except ValidationError, e:
+            return [], [(row, e.messages[0]) for row in votes]
+        dedup_key = getattr(self, 'vote_dedup_key', None)
+        keys = [None] * len(votes)
+        taken = set()
+        if dedup_key is not None:
+            keys = [dedup_key(voter, voter_ip) for voter, voter_ip, choice in votes]
+            taken = self.existing_vote_dedup_keys([key for key in keys if key is not None])
+
+        accepted, accepted_rows, rejected = [], [], []
+        for row, key in zip(votes, keys):
+            voter, voter_ip, choice = row
+            if choice.poll_id != self.pk:
+                rejected.append((row, _(u"Choice is not part of this poll")))
+                continue
+            if key is not None:
+                if key in taken:
+                    rejected.append((row, _(u"Vote with this Voter or Voter IP already exists")))
+                    continue
+                taken.add(key)
+            accepted.append(self._new_vote(choice, voter, voter_ip))
+            accepted_rows.append(row)
+
+        # votes that lost a race with a concurrent writer; unsaved votes all
+        # compare equal, so match them by identity
+        refused = set(map(id, self._insert_votes(accepted, batch_size=batch_size)))
+        if refused:
+            for row, vote in zip(accepted_rows, accepted):
+                if id(vote) in refused:
+                    rejected.append((row, _(u"Vote with this Voter or Voter IP already exists")))
+            accepted = [vote for vote in accepted if id(vote) not in refused]
+        return accepted, rejected
+
+    def _insert_votes(self, votes, batch_size=None, atomic=False):
+        """
+        Bulk insert unsaved votes and do the bookkeeping their signals would.
+        Returns the votes the database refused as duplicates. If a batch hits
+        the voter registry's constraint it is retried vote by vote, unless
+        ``atomic`` is set, which raises ValidationError instead.
+        """
+        if not votes:
+            return []
+        self.check_voting_open()
+        if self._try_write_votes(votes, batch_size):
+            # after the commit, or a concurrent results() could cache the old tally
+            invalidate_results(self.__class__, self.pk)
+            return []
+        if atomic:
+            raise ValidationError(_(u"Vote with this Voter or Voter IP already exists"))
+        refused = [vote for vote in votes if not self._try_write_votes([vote])]
+        invalidate_results(self.__class__, self.pk)
+        return refused
+
+    def _try_write_votes(self, votes, batch_size=None):
+        # False when a dedup key is taken; only these writes are rolled back,
+        # not the caller's transaction
+        try:
+            with _atomic():
+                sid = transaction.savepoint()
+                try:
+                    self._write_votes(votes, batch_size=batch_size)
+                except IntegrityError:
+                    transaction.savepoint_rollback(sid)
+                    raise
+                transaction.savepoint_commit(sid)
+        except IntegrityError:
+            return False
+        return True
+
+    def _write_votes(self, votes, batch_size=None):
+        # the writes of _insert_votes, for callers managing the transaction;
+        # they invalidate the poll's results once it is committed
+        VoterRegistration.register(votes, batch_size=batch_size)
+        new_votes = {}
+        for vote in votes:
+            new_votes.setdefault(vote.__class__, []).append(vote)
+        for vote_model, objs in new_votes.items():
+            vote_model._default_manager.bulk_create(objs, batch_size=batch_size)
+        self._count_votes(votes)
+
+    def _count_votes(self, votes):
+        counts = {}
+        for vote in votes:
+            key = (vote.choice_model(), vote.choice_id)
+            counts[key] = counts.get(key, 0) + 1
+        for (choice_model, choice_pk), count in counts.items():
+            _adjust_vote_count(choice_model, choice_pk, count)
+        if settings.ROLLUP_ON_VOTE:
+            VoteRollup.add_votes(votes)
+
+    def _save_vote(self, vote):
+        # a single INSERT, the (poll, dedup_key) constraint catches duplicates
+        self.check_voting_open()
+        try:
+            with _atomic():
+                sid = transaction.savepoint()
+                try:
+                    vote.save()
+                except IntegrityError:
+                    transaction.savepoint_rollback(sid)
+                    raise
+                transaction.savepoint_commit(sid)
+        except IntegrityError:
+            raise ValidationError(_(u"Vote with this Voter or Voter IP already exists"))
+        invalidate_results(self.__class__, self.pk)
+        return vote
 
     @classmethod
     def choices_models(cls):
-        cls._check_poll_reverse_helpers()
-        return cls._meta.poll_reverse_models['choices']
+        return poll_relations(cls).choice_models
 
     @classmethod
     def votes_models(cls):
-        cls._check_poll_reverse_helpers()
-        return cls._meta.poll_reverse_models['votes']
+        return poll_relations(cls).vote_models
 
+    @instrumented('choices')
     def choices(self):
-        self._check_poll_reverse_helpers()
+        if hasattr(self, '_choices_cache'):
+            return list(self._choices_cache)
         choices = []
-        for field_name in self._meta.poll_reverse_field_names['choices']:
+        for field_name in poll_relations(self.__class__).choice_accessors:
             choices += list(getattr(self,field_name).all())
         return choices
 
+    @instrumented('choices_objects')
     def choices_objects(self):
-        self._check_poll_reverse_helpers()
-        choices_objects = []
-        for field_name in self._meta.poll_reverse_field_names['choices']:
-            choices_objects += [ choice.content_object for choice in getattr(self,field_name).all() ]
-        return choices_objects
+        choices = self.choices()
+        resolve_content_objects(choices)
+        return [ choice.content_object for choice in choices ]
 
+    @classmethod
+    def prefetch_results(cls, polls):
+        """
+        Evaluate ``polls`` and load the choices, their content objects and
+        vote counts of all of them with one query per choice model plus one
+        per content type. Returns the polls as a list.
+        """
+        polls = list(polls)
+        polls_by_pk = dict((poll.pk, poll) for poll in polls)
+        for poll in polls:
+            poll._choices_cache = []
+        if not polls:
+            return polls
+        all_choices = []
+        for choice_model in cls.choices_models():
+            for choice in choice_model._default_manager.filter(poll__in=polls_by_pk.keys()):
+                poll = polls_by_pk[choice.poll_id]
+                choice._poll_cache = poll
+                poll._choices_cache.append(choice)
+                all_choices.append(choice)
+        resolve_content_objects(all_choices)
+        return polls
+
+    @instrumented('votes')
     def votes(self):
-        self._check_poll_reverse_helpers()
         votes = []
-        for field_name in self._meta.poll_reverse_field_names['votes']:
+        for field_name in poll_relations(self.__class__).vote_accessors:
             votes += list(getattr(self,field_name).all())
         return votes
 
+    def tally(self):
+        # {(choice_model, choice_pk): count}, choice pks are only unique per choice model
+        snapshot = self.snapshot()
+        if snapshot is not None:
+            return dict(((row.choice_model(), row.choice_id), row.count) for row in snapshot)
+        return self.tally_many([self])[self.pk]
+
+    def snapshot(self):
+        """
+        The frozen ResultSnapshot rows of a finalized poll, best ranked
+        first, or None while its results can still change.
+        """
+        if getattr(self, 'finalized_on', None) is None:
+            return None
+        if not hasattr(self, '_snapshot_cache'):
+            self._snapshot_cache = ResultSnapshot.for_poll(self) or None
+        return self._snapshot_cache
+
+    @classmethod
+    def tally_many(cls, polls):
+        # one grouped COUNT per vote model, for any number of polls
+        tallies = dict((poll.pk, {}) for poll in polls)
+        if not tallies:
+            return tallies
+        for vote_model in cls.votes_models():
+            choice_model = vote_model.choice_model()
+            rows = vote_model._default_manager.filter(poll__in=tallies.keys()).values(
+                'poll', 'choice').annotate(count=Count('pk')).order_by()
+            for row in rows:
+                tallies[row['poll']][(choice_model, row['choice'])] = row['count']
+        return tallies
+
+    def refresh_vote_counts(self):
+        # rebuild the denormalized counters from the vote rows
+        tally = self.tally_many([self])[self.pk]
+        for choice in self.choices():
+            count = tally.get((choice.__class__, choice.pk), 0)
+            if choice.vote_count != count:
+                choice.__class__._default_manager.filter(pk=choice.pk).update(vote_count=count)
+                choice.vote_count = count
+        invalidate_results(self.__class__, self.pk)
+
+    def results(self):
+        """
+        Dict of the poll's tally, standings, winner and loser, served from
+        the results cache when one is configured.
+        """
+        results = get_results(self.__class__, self.pk)
+        if results is None:
+            standings = self.standings()
+            resolve_content_objects(standings)
+            results = self._results(self.tally(), standings)
+            set_results(self.__class__, self.pk, results)
+        return results
+
+    @classmethod
+    def results_many(cls, polls):
+        """
+        {poll pk: results()} for ``polls``. Polls missing from the results
+        cache are loaded together: prefetch_results, one snapshot query and
+        one tally_many.
+        """
+        results, missing = {}, []
+        for poll in polls:
+            cached = get_results(cls, poll.pk)
+            if cached is None:
+                missing.append(poll)
+            else:
+                results[poll.pk] = cached
+        if not missing:
+            return results
+        missing = cls.prefetch_results(missing)
+        ResultSnapshot.prefetch([poll for poll in missing if getattr(poll, 'finalized_on', None) is not None])
+        tallies = cls.tally_many([poll for poll in missing if poll.snapshot() is None])
+        for poll in missing:
+            tally = tallies[poll.pk] if poll.pk in tallies else poll.tally()
+            results[poll.pk] = poll._results(tally, poll.standings())
+            set_results(cls, poll.pk, results[poll.pk])
+        return results
+
+    def _results(self, tally, standings):
+        return {
+            'tally': tally,
+            'standings': standings,
+            'winner': standings[0] if standings else None,
+            'loser': standings[-1] if standings else None,
+        }
+
+    def trend(self, resolution='hour', since=None, until=None):
+        # votes over time from the rollup tables, see VoteRollup.trend
+        return VoteRollup.trend(self, resolution, since, until)
+
+    def standings(self):
+        # choices ordered by their denormalized vote counter, most votes first,
+        # or as ranked when the poll was finalized
+        snapshot = self.snapshot()
+        if snapshot is None:
+            return sorted(self.choices(), key=lambda choice: choice.vote_count, reverse=True)
+        choices = dict(((choice.__class__, choice.pk), choice) for choice in self.choices())
+        standings = []
+        for row in snapshot:
+            choice = choices.get((row.choice_model(), row.choice_id))
+            if choice is not None:
+                choice.vote_count = row.count
+                standings.append(choice)
+        return standings
+
     @property
     def winner(self):
         # return first place choice
-        return
+        standings = self.standings()
+        if standings:
+            return standings[0]
 
     @property
     def loser(self):
         # return last place choice
-        return
+        standings = self.standings()
+        if standings:
+            return standings[-1]
 
     class VoteBase(models.Model):
         time_stamp = models.DateTimeField(auto_now_add=True)
@@ -160,27 +473,100 @@ class PollBase(models.Model):
 
         @classmethod
         def poll_model(cls):
-            return cls._meta.get_field_by_name("poll")[0].rel.to
+            return vote_relations(cls).poll_model
 
         @classmethod
         def poll_relname(cls):
-            return cls._meta.get_field_by_name('poll')[0].rel.related_name
+            return vote_relations(cls).poll_relname
 
         @classmethod
         def choice_model(cls):
-            return cls._meta.get_field_by_name("choice")[0].rel.to
+            return vote_relations(cls).choice_model
 
         @classmethod
         def choice_relname(cls):
-            return cls._meta.get_field_by_name('choice')[0].rel.related_name
+            return vote_relations(cls).choice_relname
+
+_open_poll_ids = {}
+_open_poll_ids_lock = threading.Lock()
+
+def clear_open_poll_ids(model=None):
+    with _open_poll_ids_lock:
+        if model is None:
+            _open_poll_ids.clear()
+        else:
+            _open_poll_ids.pop(model, None)
+
+class ScheduledPollManager(models.Manager):
+    """
+    Polls by voting window. Empty bounds mean the window is open on that side.
+    """
+    def active(self, now=None):
+        now = now or timezone.now()
+        return self.filter(Q(voting_opens_on__isnull=True) | Q(voting_opens_on__lte=now),
+            Q(voting_closes_on__isnull=True) | Q(voting_closes_on__gt=now))
+
+    def upcoming(self, now=None):
+        return self.filter(voting_opens_on__gt=now or timezone.now())
+
+    def closed(self, now=None):
+        return self.filter(voting_closes_on__lte=now or timezone.now())
+
+    def open_ids(self):
+        """
+        Frozenset of the pks of the currently open polls, cached in process
+        for OPEN_POLLS_CACHE_TIMEOUT seconds and dropped whenever a poll of
+        the model is saved.
+        """
+        now = time.time()
+        cached = _open_poll_ids.get(self.model)
+        if cached is not None and cached[0] > now:
+            return cached[1]
+        ids = frozenset(self.active().values_list('pk', flat=True))
+        with _open_poll_ids_lock:
+            _open_poll_ids[self.model] = (now + settings.OPEN_POLLS_CACHE_TIMEOUT, ids)
+        return ids
+
+    def finalize_closed(self, now=None):
+        # the scheduler hook: finalize polls whose window has passed, returns how many
+        finalized = 0
+        for poll in self.closed(now).filter(finalized_on__isnull=True).iterator():
+            poll.finalize()
+            finalized += 1
+        return finalized
 
 class ScheduledPollMixin(models.Model):
-    voting_opens_on = models.DateTimeField(default=datetime.now(), null=True, blank=True)
-    voting_closes_on = models.DateTimeField(default=datetime.now(), null=True, blank=True)
+    voting_opens_on = models.DateTimeField(default=timezone.now, null=True, blank=True, db_index=True)
+    voting_closes_on = models.DateTimeField(null=True, blank=True, db_index=True)
+    finalized_on = models.DateTimeField(null=True, blank=True, editable=False)
+
+    objects = ScheduledPollManager()
 
     class Meta:
         abstract = True
 
+    def is_open(self, now=None):
+        now = now or timezone.now()
+        return ((self.voting_opens_on is None or self.voting_opens_on <= now) and
+            (self.voting_closes_on is None or now < self.voting_closes_on))
+
+    def save(self, *args, **kwargs):
+        super(ScheduledPollMixin, self).save(*args, **kwargs)
+        clear_open_poll_ids(self.__class__)
+
+    def finalize(self):
+        """
+        Freeze the results of a closed poll: recount the vote counters from
+        the votes, store a ResultSnapshot, stamp finalized_on and send
+        poll_finalized.
+        """
+        self.refresh_vote_counts()
+        ResultSnapshot.take([self])
+        self.finalized_on = timezone.now()
+        self.__class__._default_manager.filter(pk=self.pk).update(finalized_on=self.finalized_on)
+        invalidate_results(self.__class__, self.pk)
+        poll_finalized.send(sender=self.__class__, poll=self)
+
 class OneVotePerUserMixin(models.Model):
     one_vote_per_ip = models.BooleanField(default=True,)
     one_vote_per_user = models.BooleanField(default=True,)
@@ -189,35 +575,198 @@ class OneVotePerUserMixin(models.Model):
     class Meta:
         abstract = True
 
+    def vote_dedup_key(self, voter, voter_ip):
+        """
+        Key a vote by ``voter`` (a user or its pk) from ``voter_ip`` is stored
+        with, None when the vote is unrestricted. The vote tables are unique
+        on (poll, dedup_key).
+        """
+        voter_id = getattr(voter, 'pk', voter)
+        if self.one_vote_per_user and voter_id is not None:
+            return u'voter:%s' % voter_id
+        elif self.one_vote_per_ip:
+            return u'ip:%s' % voter_ip
+        return None
+
+    def existing_vote_dedup_keys(self, keys):
+        # set of the given dedup keys already taken by votes of this poll
+        return VoterRegistration.taken(self, keys)
+
     class VoteBase(models.Model):
         voter_ip = models.IPAddressField(blank=True,default='')
         if django.VERSION < (1, 2):
             voter = models.ForeignKey(UserModel,related_name="%(class)s_votes", blank=True,null=True)
         else:
             voter = models.ForeignKey(UserModel,related_name="%(app_label)s_%(class)s_votes",blank=True,null=True)
-        
+        # the poll's one-vote rule this vote falls under, see vote_dedup_key
+        dedup_key = models.CharField(max_length=64, null=True, blank=True, editable=False)
+
+        # picked up by ChoiceMetaClass for the generated vote classes
+        vote_unique_together = (('poll', 'dedup_key'),)
+
+        class Meta:
+            abstract = True
+
+        def set_dedup_key(self):
+            self.dedup_key = self.poll.vote_dedup_key(self.voter_id, self.voter_ip)
+
+        def save(self, *args, **kwargs):
+            if not self._state.adding:
+                return super(OneVotePerUserMixin.VoteBase, self).save(*args, **kwargs)
+            if self.dedup_key is None:
+                self.set_dedup_key()
+            # the registration, the vote and its counter commit together
+            with _atomic():
+                # raises IntegrityError if any vote table of the poll has the key
+                VoterRegistration.register([self])
+                super(OneVotePerUserMixin.VoteBase, self).save(*args, **kwargs)
+            # again once committed, post_save's invalidation came before it
+            invalidate_results(self.poll_model(), self.poll_id)
+
+        @instrumented('validate_unique')
+        def validate_unique(self, exclude=None):
+            if self._state.adding and self.dedup_key is None:
+                self.set_dedup_key()
+            if self._state.adding and self.dedup_key is not None:
+                if VoterRegistration.taken(self.poll, [self.dedup_key]):
+                    raise ValidationError(_(u"%s with this Voter or Voter IP already exist") % self.__class__.__name__)
+
+            # (poll, dedup_key) is checked above
+            exclude = list(exclude or []) + ['dedup_key']
+            super(OneVotePerUserMixin.VoteBase,self).validate_unique(exclude)
+
+class RankedPollMixin(models.Model):
+    # ballots rank choices of the poll's (single) choice model
+
+    class Meta:
+        abstract = True
+
+    def cast_ballot(self, voter, choice_objects, voter_ip=''):
+        # choice_objects are choices or their objects, most preferred first;
+        # a choice ranked again is left at its first place
+        choices = []
+        for choice_object in choice_objects:
+            choice = self.get_choice(choice_object)
+            if choice not in choices:
+                choices.append(choice)
+        if not choices:
+            raise ValidationError(_(u"A ballot needs at least one choice"))
+        if len(set(choice.__class__ for choice in choices)) > 1:
+            raise ValidationError(_(u"A ballot can only rank choices of one kind"))
+        vote = self._new_vote(choices[0], voter, voter_ip)
+        vote.set_ranking(choices)
+        return self._save_vote(vote)
+
+    def ballot_box(self):
+        # read the ballots straight into a compact BallotBox
+        box = BallotBox(choice.pk for choice in self.choices())
+        for vote_model in self.votes_models():
+            rows = vote_model._default_manager.filter(poll=self).values_list('choice', 'ballot')
+            for choice_id, ballot in rows.iterator():
+                box.add(vote_model.parse_ballot(ballot) or [choice_id])
+        return box
+
+    def instant_runoff(self):
+        """
+        RunoffResult of the poll's ranked ballots, with choice pks as the
+        winner, round and elimination entries.
+        """
+        return instant_runoff(self.ballot_box())
+
+    class VoteBase(models.Model):
+        # pks of the ranked choices, most preferred first; choice is the first
+        ballot = models.CommaSeparatedIntegerField(max_length=1024, blank=True)
+
         class Meta:
             abstract = True
 
-        def validate_unique(self,*args,**kwargs):
-            lookup_kwargs = {'poll': self.poll,}
-            do_check = False
+        @staticmethod
+        def parse_ballot(ballot):
+            return [int(pk) for pk in ballot.split(',') if pk]
 
-            if self.poll.one_vote_per_user and self.voter is not None:
-                lookup_kwargs['voter']=self.voter
-                do_check |= True
-            elif self.poll.one_vote_per_ip:
-                lookup_kwargs['voter_ip']=self.voter_ip
-                do_check |= True
+        def get_ranking(self):
+            return self.parse_ballot(self.ballot) or [self.choice_id]
 
-            if do_check:
-                qs = self._default_manager.filter(**lookup_kwargs)
-                if not self._state.adding and self.pk is not None:
-                    qs.exclude(pk=self.pk)
-                if qs.exists():
-                    raise ValidationError(_(u"%s with this Voter or Voter IP already exist" % self.__name__))
+        def set_ranking(self, choices):
+            self.choice = choices[0]
+            self.ballot = ','.join([str(choice.pk) for choice in choices])
 
-            super(OneVotePerUserMixin.VoteBase,self).validate_unique(*args,**kwargs)
+class ApprovalPollMixin(models.Model):
+    # a ballot approves any number of choices, stored as one vote row each
+
+    class Meta:
+        abstract = True
+
+    def cast_approval(self, voter, choice_objects, voter_ip=''):
+        """
+        Approve ``choice_objects`` (choices or their objects) in one ballot.
+        The poll's one-vote rules apply to the ballot as a whole.
+        """
+        choices = []
+        for choice_object in choice_objects:
+            choice = self.get_choice(choice_object)
+            if choice not in choices:
+                choices.append(choice)
+        if not choices:
+            raise ValidationError(_(u"A ballot needs at least one choice"))
+        votes = self._new_ballot(choices, voter, voter_ip)
+        self._insert_votes(votes, atomic=True)
+        return votes
+
+    def approvals(self):
+        # {(choice_model, choice_pk): approvals}, one COUNT per vote model
+        return self.tally()
+
+class ScorePollMixin(models.Model):
+    # every vote row carries a numeric score or weight for its choice
+
+    class Meta:
+        abstract = True
+
+    def cast_scores(self, voter, scores, voter_ip=''):
+        """
+        Score choices in one ballot. ``scores`` is an iterable of
+        (choice or its object, score) pairs.
+        """
+        scores = [(self.get_choice(choice_object), score) for choice_object, score in scores]
+        votes = self._new_ballot([choice for choice, score in scores], voter, voter_ip)
+        for vote, (choice, score) in zip(votes, scores):
+            vote.weight = score
+        if not votes:
+            raise ValidationError(_(u"A ballot needs at least one choice"))
+        if len(set([(vote.__class__, vote.choice_id) for vote in votes])) != len(votes):
+            raise ValidationError(_(u"A choice can only be scored once per ballot"))
+        self._insert_votes(votes, atomic=True)
+        return votes
+
+    def score_totals(self):
+        """
+        {(choice_model, choice_pk): {'count', 'total', 'mean'}} computed by
+        the database, one grouped query per vote model.
+        """
+        totals = {}
+        for vote_model in self.votes_models():
+            choice_model = vote_model.choice_model()
+            rows = vote_model._default_manager.filter(poll=self).values('choice').annotate(
+                count=Count('pk'), total=Sum('weight'), mean=Avg('weight')).order_by()
+            for row in rows:
+                totals[(choice_model, row['choice'])] = {
+                    'count': row['count'], 'total': row['total'], 'mean': row['mean'],
+                }
+        return totals
+
+    def score_standings(self):
+        # choices ordered by their total score, highest first
+        totals = self.score_totals()
+        def total(choice):
+            return totals.get((choice.__class__, choice.pk), {}).get('total') or 0
+        return sorted(self.choices(), key=total, reverse=True)
+
+    class VoteBase(models.Model):
+        weight = models.FloatField(default=1)
+
+        class Meta:
+            abstract = True
 
 class Poll(PollBase,ScheduledPollMixin,OneVotePerUserMixin):    
     class Meta:
@@ -234,6 +783,10 @@ class ChoiceMetaClass(models.base.ModelBase):
                 # Using type('Meta', ...) gives a dictproxy error during model creation
                 pass
             setattr(VoteClassInnerMeta, 'app_label', new._meta.app_label)
+            # the mixins' vote lookups are served by these composite unique indexes
+            vote_unique_together = getattr(new.poll_model().VoteBase, 'vote_unique_together', ())
+            if vote_unique_together:
+                setattr(VoteClassInnerMeta, 'unique_together', vote_unique_together)
 
             attrs = {'__module__': new.__module__, 'Meta': VoteClassInnerMeta}
             if django.VERSION < (1, 2):
@@ -245,8 +798,85 @@ class ChoiceMetaClass(models.base.ModelBase):
             VoteClass = type(vote_class_name, (new.poll_model().VoteBase,), attrs)
             setattr(sys.modules[new.__module__],vote_class_name,VoteClass)
 
+            # keep the choice's vote counter in step with its votes
+            if 'vote_count' not in [f.name for f in new._meta.fields]:
+                new.add_to_class('vote_count', models.PositiveIntegerField(default=0, editable=False, db_index=True))
+            post_save.connect(_vote_saved, sender=VoteClass, weak=False)
+            post_delete.connect(_vote_deleted, sender=VoteClass, weak=False)
+            post_save.connect(_choice_changed, sender=new, weak=False)
+            # deleting a choice or poll releases its votes' keys in bulk, see _deleting
+            pre_delete.connect(_choice_deleting, sender=new, weak=False)
+            post_delete.connect(_choice_deleted, sender=new, weak=False)
+            pre_delete.connect(_poll_deleting, sender=new.poll_model(), weak=False,
+                dispatch_uid='pollup_poll_deleting')
+            post_save.connect(_poll_saved, sender=new.poll_model(), weak=False,
+                dispatch_uid='pollup_poll_saved')
+            post_delete.connect(_poll_deleted, sender=new.poll_model(), weak=False,
+                dispatch_uid='pollup_poll_deleted')
+
         return new
 
+def _adjust_vote_count(choice_model, choice_pk, delta):
+    choice_model._default_manager.filter(pk=choice_pk).update(vote_count=F('vote_count') + delta)
+
+def _vote_saved(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        _adjust_vote_count(sender.choice_model(), instance.choice_id, 1)
+        if settings.ROLLUP_ON_VOTE:
+            VoteRollup.add_votes([instance])
+    invalidate_results(sender.poll_model(), instance.poll_id)
+
+# (model, pk) of the choices and polls this thread is deleting; their votes'
+# bookkeeping is done once per choice or poll instead of once per vote
+_cascade = threading.local()
+
+def _deleting():
+    deleting = getattr(_cascade, 'deleting', None)
+    if deleting is None:
+        deleting = _cascade.deleting = set()
+    return deleting
+
+def _vote_deleted(sender, instance, **kwargs):
+    deleting = _deleting()
+    if ((sender.choice_model(), instance.choice_id) in deleting or
+            (sender.poll_model(), instance.poll_id) in deleting):
+        return
+    _adjust_vote_count(sender.choice_model(), instance.choice_id, -1)
+    if getattr(instance, 'dedup_key', None) is not None:
+        VoterRegistration.release(sender.poll_model(), instance.poll_id, instance.dedup_key)
+    invalidate_results(sender.poll_model(), instance.poll_id)
+
+def _choice_changed(sender, instance, **kwargs):
+    invalidate_results(sender.poll_model(), instance.poll_id)
+    clear_choice_lookups(sender.poll_model(), instance.poll_id)
+
+def _choice_deleting(sender, instance, **kwargs):
+    # release the keys of the choice's votes with one DELETE, its counter goes with it
+    _deleting().add((sender, instance.pk))
+    vote_model = sender.vote_model()
+    if 'dedup_key' in vote_model._meta.get_all_field_names():
+        keys = vote_model._default_manager.filter(choice=instance).exclude(dedup_key=None).values('dedup_key')
+        VoterRegistration._default_manager.filter(poll_type=get_content_type(sender.poll_model()),
+            poll_id=instance.poll_id, dedup_key__in=keys).delete()
+
+def _choice_deleted(sender, instance, **kwargs):
+    _deleting().discard((sender, instance.pk))
+    invalidate_results(sender.poll_model(), instance.poll_id)
+    clear_choice_lookups(sender.poll_model(), instance.poll_id)
+
+def _poll_deleting(sender, instance, **kwargs):
+    _deleting().add((sender, instance.pk))
+    VoterRegistration._default_manager.filter(poll_type=get_content_type(sender),
+        poll_id=instance.pk).delete()
+
+def _poll_saved(sender, instance, **kwargs):
+    clear_poll_lookups(sender, instance.pk)
+
+def _poll_deleted(sender, instance, **kwargs):
+    _deleting().discard((sender, instance.pk))
+    invalidate_results(sender, instance.pk)
+    clear_poll_lookups(sender, instance.pk)
+
 class ChoiceBase(models.Model):
     __metaclass__ = ChoiceMetaClass
 
@@ -261,11 +891,15 @@ class ChoiceBase(models.Model):
 
     @classmethod
     def poll_model(cls):
-        return cls._meta.get_field_by_name("poll")[0].rel.to
+        return choice_relations(cls).poll_model
 
     @classmethod
     def poll_relname(cls):
-        return cls._meta.get_field_by_name('poll')[0].rel.related_name
+        return choice_relations(cls).poll_relname
+
+    @classmethod
+    def vote_model(cls):
+        return choice_relations(cls).vote_model
 
     @classmethod
     def lookup_kwargs(cls, instance):
@@ -279,6 +913,19 @@ class ChoiceBase(models.Model):
             "content_object__in": instances,
         }
 
+    @classmethod
+    def object_id_field_name(cls):
+        # column holding the pk of the chosen object
+        return 'content_object'
+
+    @classmethod
+    def group_instances(cls, instances):
+        # split instances into groups that bulk_lookup_kwargs can take at once
+        instances = list(instances)
+        if instances:
+            return [instances]
+        return []
+
     @classmethod
     def choices_for(cls, model, instance=None):
         if instance is not None:
@@ -308,6 +955,52 @@ class PollChoiceBase(ChoiceBase):
             '%s__content_object__isnull' % cls.poll_relname(): False
         }).distinct()
 
+_content_types = {}
+
+def get_content_type(model):
+    # memoized ContentType.objects.get_for_model, cleared whenever models or
+    # content types may have changed
+    if not isinstance(model, type):
+        model = model.__class__
+    try:
+        return _content_types[model]
+    except KeyError:
+        ct = _content_types[model] = ContentType.objects.get_for_model(model)
+        return ct
+
+def choice_token(choice):
+    # identifies a choice among all choice models, for forms and URLs
+    return '%s-%s' % (get_content_type(choice).pk, choice.pk)
+
+def parse_choice_token(token):
+    # (content type pk, choice pk), ValueError if malformed
+    content_type_id, choice_id = token.split('-')
+    return int(content_type_id), int(choice_id)
+
+def clear_content_type_cache(**kwargs):
+    _content_types.clear()
+
+post_syncdb.connect(clear_content_type_cache, dispatch_uid='pollup_clear_content_types')
+class_prepared.connect(clear_content_type_cache, dispatch_uid='pollup_clear_content_types')
+
+def resolve_content_objects(choices):
+    # fill in the content_object of choices with one in_bulk per content model
+    wanted = {}
+    for choice in choices:
+        if hasattr(choice, '_content_object_cache'):
+            continue
+        if isinstance(choice, GenericChoiceBase):
+            model = ContentType.objects.get_for_id(choice.content_type_id).model_class()
+            pk = choice.object_id
+        else:
+            field = choice._meta.get_field('content_object')
+            model, pk = field.rel.to, getattr(choice, field.attname)
+        wanted.setdefault(model, []).append((choice, pk))
+    for model, pairs in wanted.items():
+        objects = model._default_manager.in_bulk(set([pk for choice, pk in pairs]))
+        for choice, pk in pairs:
+            choice._content_object_cache = objects.get(pk)
+
 class GenericChoiceBase(ChoiceBase):
     object_id = models.IntegerField(verbose_name=_('Object id'), db_index=True)
     if django.VERSION < (1, 2):
@@ -331,20 +1024,33 @@ class GenericChoiceBase(ChoiceBase):
     def lookup_kwargs(cls, instance):
         return {
             'object_id': instance.pk,
-            'content_type': ContentType.objects.get_for_model(instance)
+            'content_type': get_content_type(instance)
         }
 
     @classmethod
     def bulk_lookup_kwargs(cls, instances):
-        # TODO: instances[0], can we assume there are instances.... 
+        # instances must share a model, see group_instances
+        if not instances:
+            return {"object_id__in": []}
         return {
             "object_id__in": [instance.pk for instance in instances],
-            "content_type": ContentType.objects.get_for_model(instances[0]),
+            "content_type": get_content_type(instances[0]),
         }
 
+    @classmethod
+    def object_id_field_name(cls):
+        return 'object_id'
+
+    @classmethod
+    def group_instances(cls, instances):
+        groups = {}
+        for instance in instances:
+            groups.setdefault(get_content_type(instance).pk, []).append(instance)
+        return groups.values()
+
     @classmethod
     def choices_for(cls, model, instance=None):
-        ct = ContentType.objects.get_for_model(model)
+        ct = get_content_type(model)
         kwargs = {
             "%s__content_type" % cls.poll_relname(): ct
         }
@@ -355,4 +1061,243 @@ class GenericChoiceBase(ChoiceBase):
 class PollChoice(GenericChoiceBase,PollChoiceBase):
     class Meta:
         verbose_name = _("Poll Choice")
-        verbose_name_plural = _("Poll Choices")
\ No newline at end of file
+        verbose_name_plural = _("Poll Choices")
+
+def vote_models():
+    # every concrete vote model generated for a choice model
+    tables = get_tables()
+    if tables is not None:
+        return tables[2].keys()
+    return [model for model in models.get_models() if issubclass(model, PollBase.VoteBase)]
+
+RESOLUTION_CHOICES = (
+    ('minute', _('Minute')),
+    ('hour', _('Hour')),
+    ('day', _('Day')),
+)
+
+def rollup_bucket(time_stamp, resolution):
+    if resolution == 'minute':
+        return time_stamp.replace(second=0, microsecond=0)
+    if resolution == 'hour':
+        return time_stamp.replace(minute=0, second=0, microsecond=0)
+    return time_stamp.replace(hour=0, minute=0, second=0, microsecond=0)
+
+class VoterRegistration(models.Model):
+    """
+    The dedup keys taken in a poll, whichever of its vote tables the vote
+    went to. Unique on (poll, key) so one INSERT enforces the one-vote rules
+    across all of them.
+    """
+    poll_type = models.ForeignKey(ContentType, related_name="+")
+    poll_id = models.PositiveIntegerField()
+    dedup_key = models.CharField(max_length=64)
+
+    class Meta:
+        unique_together = (('poll_type', 'poll_id', 'dedup_key'),)
+        verbose_name = _("Voter registration")
+        verbose_name_plural = _("Voter registrations")
+
+    @classmethod
+    def register(cls, votes, batch_size=None):
+        # raises IntegrityError if a key is already taken in its poll
+        registrations = [cls(poll_type=get_content_type(vote.poll_model()), poll_id=vote.poll_id,
+            dedup_key=vote.dedup_key) for vote in votes if getattr(vote, 'dedup_key', None) is not None]
+        if registrations:
+            cls._default_manager.bulk_create(registrations, batch_size=batch_size)
+
+    @classmethod
+    def taken(cls, poll, keys):
+        # set of ``keys`` taken in ``poll``, one query
+        keys = set(keys)
+        keys.discard(None)
+        if not keys:
+            return set()
+        return set(cls._default_manager.filter(poll_type=get_content_type(poll), poll_id=poll.pk,
+            dedup_key__in=keys).values_list('dedup_key', flat=True))
+
+    @classmethod
+    def release(cls, poll_model, poll_pk, key):
+        cls._default_manager.filter(poll_type=get_content_type(poll_model), poll_id=poll_pk,
+            dedup_key=key).delete()
+
+class ResultSnapshot(models.Model):
+    """
+    Final count, rank and label of one choice of a finalized poll.
+    """
+    poll_type = models.ForeignKey(ContentType, related_name="+")
+    poll_id = models.PositiveIntegerField()
+    choice_type = models.ForeignKey(ContentType, related_name="+")
+    choice_id = models.PositiveIntegerField()
+    count = models.PositiveIntegerField(default=0)
+    # 1 for the most votes, tied choices share a rank
+    rank = models.PositiveIntegerField()
+    label = models.CharField(max_length=255, blank=True)
+    taken_on = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = (('poll_type', 'poll_id', 'choice_type', 'choice_id'),)
+        verbose_name = _("Result snapshot")
+        verbose_name_plural = _("Result snapshots")
+
+    def choice_model(self):
+        return ContentType.objects.get_for_id(self.choice_type_id).model_class()
+
+    @classmethod
+    def for_poll(cls, poll):
+        return list(cls._default_manager.filter(poll_type=get_content_type(poll),
+            poll_id=poll.pk).order_by('rank', 'pk'))
+
+    @classmethod
+    def prefetch(cls, polls):
+        # load the snapshots of finalized polls sharing a model in one query
+        if not polls:
+            return
+        snapshots = dict((poll.pk, []) for poll in polls)
+        for row in cls._default_manager.filter(poll_type=get_content_type(polls[0]),
+                poll_id__in=snapshots.keys()).order_by('rank', 'pk'):
+            snapshots[row.poll_id].append(row)
+        for poll in polls:
+            poll._snapshot_cache = snapshots[poll.pk] or None
+
+    @classmethod
+    def take(cls, polls):
+        """
+        Replace the snapshots of ``polls``, which must share a model, with
+        their current results. Counts come from the vote rows; the choices
+        and their labels are read with prefetch_results.
+        """
+        if not polls:
+            return
+        poll_model = polls[0].__class__
+        polls = poll_model.prefetch_results(polls)
+        tallies = poll_model.tally_many(polls)
+        poll_type = get_content_type(poll_model)
+        snapshots = []
+        for poll in polls:
+            tally = tallies[poll.pk]
+            counted = [(tally.get((choice.__class__, choice.pk), 0), choice) for choice in poll.choices()]
+            counted.sort(key=lambda pair: pair[0], reverse=True)
+            rank = 0
+            for position, (count, choice) in enumerate(counted, 1):
+                if position == 1 or count != counted[position - 2][0]:
+                    rank = position
+                snapshots.append(cls(poll_type=poll_type, poll_id=poll.pk,
+                    choice_type=get_content_type(choice), choice_id=choice.pk, count=count,
+                    rank=rank, label=unicode(choice.content_object)[:255]))
+        with transaction.commit_on_success():
+            cls._default_manager.filter(poll_type=poll_type, poll_id__in=[poll.pk for poll in polls]).delete()
+            cls._default_manager.bulk_create(snapshots)
+        for poll in polls:
+            poll.__dict__.pop('_snapshot_cache', None)
+
+class VoteRollup(models.Model):
+    """
+    Number of votes a choice got in a poll during one minute, hour or day.
+    """
+    poll_type = models.ForeignKey(ContentType, related_name="+")
+    poll_id = models.PositiveIntegerField()
+    resolution = models.CharField(max_length=10, choices=RESOLUTION_CHOICES)
+    bucket = models.DateTimeField()
+    choice_type = models.ForeignKey(ContentType, related_name="+")
+    choice_id = models.PositiveIntegerField()
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        # leading columns double as the index trend() reads
+        unique_together = (('poll_type', 'poll_id', 'resolution', 'bucket', 'choice_type', 'choice_id'),)
+        verbose_name = _("Vote rollup")
+        verbose_name_plural = _("Vote rollups")
+
+    @classmethod
+    def add_votes(cls, votes):
+        # count saved votes into their buckets, one UPDATE (or INSERT) per bucket
+        counts = {}
+        for vote in votes:
+            poll_type = get_content_type(vote.poll_model()).pk
+            choice_type = get_content_type(vote.choice_model()).pk
+            for resolution in settings.ROLLUP_RESOLUTIONS:
+                key = (poll_type, vote.poll_id, resolution,
+                    rollup_bucket(vote.time_stamp, resolution), choice_type, vote.choice_id)
+                counts[key] = counts.get(key, 0) + 1
+        for (poll_type, poll_id, resolution, bucket, choice_type, choice_id), count in counts.items():
+            lookup = {
+                'poll_type': poll_type, 'poll_id': poll_id, 'resolution': resolution,
+                'bucket': bucket, 'choice_type': choice_type, 'choice_id': choice_id,
+            }
+            if cls._default_manager.filter(**lookup).update(count=F('count') + count):
+                continue
+            # a concurrent first vote in the bucket may insert the row first;
+            # then add to it, never fail the vote over its rollup
+            sid = transaction.savepoint()
+            try:
+                cls._default_manager.create(count=count, poll_type_id=poll_type, poll_id=poll_id,
+                    resolution=resolution, bucket=bucket, choice_type_id=choice_type, choice_id=choice_id)
+            except IntegrityError:
+                transaction.savepoint_rollback(sid)
+                cls._default_manager.filter(**lookup).update(count=F('count') + count)
+            else:
+                transaction.savepoint_commit(sid)
+
+    @classmethod
+    def trend(cls, poll, resolution='hour', since=None, until=None):
+        """
+        [(bucket, {(choice_model, choice_pk): count}), ...] for ``poll``,
+        oldest bucket first.
+        """
+        qs = cls._default_manager.filter(poll_type=get_content_type(poll), poll_id=poll.pk,
+            resolution=resolution)
+        if since is not None:
+            qs = qs.filter(bucket__gte=rollup_bucket(since, resolution))
+        if until is not None:
+            qs = qs.filter(bucket__lte=until)
+        trend = []
+        for bucket, choice_type, choice_id, count in qs.order_by('bucket').values_list(
+                'bucket', 'choice_type', 'choice_id', 'count'):
+            if not trend or trend[-1][0] != bucket:
+                trend.append((bucket, {}))
+            choice_model = ContentType.objects.get_for_id(choice_type).model_class()
+            trend[-1][1][(choice_model, choice_id)] = count
+        return trend
+
+class ImportMark(models.Model):
+    """
+    Number of input rows of a pollup_import source already loaded.
+    """
+    source = models.CharField(max_length=255, unique=True)
+    rows = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        verbose_name = _("Import mark")
+        verbose_name_plural = _("Import marks")
+
+class RollupMark(models.Model):
+    """
+    Highest vote pk of a vote model already counted into the rollups.
+    """
+    vote_type = models.ForeignKey(ContentType, unique=True, related_name="+")
+    last_pk = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        verbose_name = _("Rollup mark")
+        verbose_name_plural = _("Rollup marks")
+
+    @classmethod
+    def process(cls, vote_model, chunk_size=1000):
+        """
+        Count the votes of ``vote_model`` past the mark into the rollups, one
+        transaction per chunk that also moves the mark. Safe to stop and rerun.
+        Returns the number of votes counted.
+        """
+        vote_type = get_content_type(vote_model)
+        processed = 0
+        while True:
+            with transaction.commit_on_success():
+                mark, created = cls._default_manager.select_for_update().get_or_create(vote_type=vote_type)
+                votes = list(vote_model._default_manager.filter(pk__gt=mark.last_pk).order_by('pk')[:chunk_size])
+                if not votes:
+                    return processed
+                VoteRollup.add_votes(votes)
+                mark.last_pk = votes[-1].pk
+                mark.save()
+            processed += len(votes)
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+In-process publisher of live tallies.
+
+Streams subscribe to a poll through the process wide ``TallyPublisher``. Every
+``STREAM_INTERVAL`` seconds its thread counts the votes of all subscribed polls
+(one ``tally_many()`` per poll model, whatever the number of clients) and
+pushes the per-choice changes since the last count to each subscriber's
+queue. Votes are counted from the database, so writes from every vote model
+and every process show up; no broker is involved.
+"""
+import logging
+import threading
+import time
+import Queue
+
+from django.db import connection
+
+from pollup import settings
+
+logger = logging.getLogger('pollup')
+
+# events a slow client may fall behind by before it is resynced
+QUEUE_SIZE = 100
+
+
+class Subscription(object):
+    def __init__(self, publisher, poll):
+        self.publisher = publisher
+        self.poll = poll
+        self.queue = Queue.Queue(QUEUE_SIZE)
+        # the full tally the first queued delta applies to, set by the publisher
+        self.tally = None
+        # set when events were dropped, the stream sends a full tally then
+        self.overflowed = False
+
+    def get(self, timeout=None):
+        # next (kind, data) event, Queue.Empty after timeout seconds
+        return self.queue.get(True, timeout)
+
+    def put(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except Queue.Full:
+            self.overflowed = True
+
+    def resync(self):
+        # drop queued events, returns the current full tally
+        return self.publisher.resync(self)
+
+    def close(self):
+        self.publisher.unsubscribe(self)
+
+
+class TallyPublisher(object):
+    def __init__(self, interval=None, threaded=True):
+        self.interval = interval if interval is not None else settings.STREAM_INTERVAL
+        self.threaded = threaded
+        self.lock = threading.Lock()
+        # (poll class, poll pk) -> [poll, set of subscriptions]
+        self.polls = {}
+        # (poll class, poll pk) -> tally last published
+        self.tallies = {}
+        self._thread = None
+
+    def subscribe(self, poll):
+        """
+        A Subscription to ``poll``. Its ``tally`` and the first delta it
+        receives are taken under the same lock, so no change is counted twice.
+        """
+        subscription = Subscription(self, poll)
+        with self.lock:
+            self.polls.setdefault((poll.__class__, poll.pk), [poll, set()])[1].add(subscription)
+            subscription.tally = self._current(poll)
+        self._ensure_thread()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        poll_key = (subscription.poll.__class__, subscription.poll.pk)
+        with self.lock:
+            entry = self.polls.get(poll_key)
+            if entry is not None:
+                entry[1].discard(subscription)
+                if not entry[1]:
+                    del self.polls[poll_key]
+                    self.tallies.pop(poll_key, None)
+
+    def resync(self, subscription):
+        with self.lock:
+            subscription.overflowed = False
+            while True:
+                try:
+                    subscription.queue.get_nowait()
+                except Queue.Empty:
+                    break
+            subscription.tally = self._current(subscription.poll)
+        return subscription.tally
+
+    def _current(self, poll):
+        # the tally subscribers were last brought up to, counted if there is
+        # none; called with the lock held
+        poll_key = (poll.__class__, poll.pk)
+        tally = self.tallies.get(poll_key)
+        if tally is None:
+            tally = self.tallies[poll_key] = poll.__class__.tally_many([poll])[poll.pk]
+        return dict(tally)
+
+    def tick(self):
+        """
+        Count the subscribed polls and publish what changed. Returns the
+        number of polls with changes.
+        """
+        with self.lock:
+            entries = dict((poll_key, entry[0]) for poll_key, entry in self.polls.items())
+        by_model = {}
+        for (poll_model, poll_pk), poll in entries.items():
+            by_model.setdefault(poll_model, []).append(poll)
+        changed = 0
+        for poll_model, polls in by_model.items():
+            tallies = poll_model.tally_many(polls)
+            for poll in polls:
+                if self._publish((poll_model, poll.pk), tallies[poll.pk]):
+                    changed += 1
+        return changed
+
+    def _publish(self, poll_key, tally):
+        with self.lock:
+            entry = self.polls.get(poll_key)
+            if entry is None:
+                return False
+            last = self.tallies.get(poll_key)
+            self.tallies[poll_key] = tally
+            if last is None:
+                return False
+            delta = {}
+            for key in set(tally) | set(last):
+                difference = tally.get(key, 0) - last.get(key, 0)
+                if difference:
+                    delta[key] = difference
+            if not delta:
+                return False
+            for subscription in entry[1]:
+                subscription.put(('delta', delta))
+            return True
+
+    def _ensure_thread(self):
+        if self._thread is not None or not self.threaded:
+            return
+        with self.lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='pollup-publisher')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            if not self.polls:
+                continue
+            try:
+                self.tick()
+            except Exception:
+                logger.exception(u"Publishing poll tallies failed")
+            finally:
+                # don't keep reading from one transaction's snapshot
+                connection.close()
+
+
+_publisher = None
+_publisher_lock = threading.Lock()
+
+def get_publisher():
+    global _publisher
+    if _publisher is None:
+        with _publisher_lock:
+            if _publisher is None:
+                _publisher = TallyPublisher()
+    return _publisher
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Frozen lookup tables of how poll, choice and vote models relate.
+
+Django 1.4 has no app-ready hook, so the tables are built in one pass over the
+model cache the first time they are needed after the cache is fully loaded,
+and thrown away when another model class is prepared. Readers only ever see a
+complete snapshot of immutable tuples and never take the lock. Lookups made
+while the app cache is still loading are answered from ``_meta`` directly.
+"""
+import threading
+from collections import namedtuple
+
+from django.db import models
+from django.db.models.loading import cache as app_cache
+from django.db.models.signals import class_prepared
+
+PollRelations = namedtuple('PollRelations', 'choice_accessors choice_models vote_accessors vote_models')
+ChoiceRelations = namedtuple('ChoiceRelations', 'poll_model poll_relname vote_model')
+VoteRelations = namedtuple('VoteRelations', 'poll_model poll_relname choice_model choice_relname')
+
+_tables = None
+_generation = 0
+_lock = threading.Lock()
+
+
+def _poll_relations(model):
+    from pollup.models import ChoiceBase
+    found = {'choices': ([], []), 'votes': ([], [])}
+    for rel in model._meta.get_all_related_objects():
+        if type(rel.field) != models.ForeignKey:
+            continue
+        if issubclass(rel.field.model, ChoiceBase):
+            key = 'choices'
+        elif issubclass(rel.field.model, model.VoteBase):
+            key = 'votes'
+        else:
+            continue
+        found[key][0].append(rel.get_accessor_name())
+        found[key][1].append(rel.field.model)
+    return PollRelations(tuple(found['choices'][0]), tuple(found['choices'][1]),
+        tuple(found['votes'][0]), tuple(found['votes'][1]))
+
+def _choice_relations(model):
+    poll = model._meta.get_field('poll')
+    votes = getattr(model, 'votes', None)
+    return ChoiceRelations(poll.rel.to, poll.rel.related_name,
+        votes.related.model if votes is not None else None)
+
+def _vote_relations(model):
+    poll, choice = model._meta.get_field('poll'), model._meta.get_field('choice')
+    return VoteRelations(poll.rel.to, poll.rel.related_name, choice.rel.to, choice.rel.related_name)
+
+def _build():
+    from pollup.models import PollBase, ChoiceBase
+    polls, choices, votes = {}, {}, {}
+    for model in models.get_models():
+        if issubclass(model, PollBase):
+            polls[model] = _poll_relations(model)
+        elif issubclass(model, ChoiceBase):
+            relations = _choice_relations(model)
+            # a choice model whose vote model is still being created
+            if relations.vote_model is not None:
+                choices[model] = relations
+        elif issubclass(model, PollBase.VoteBase):
+            votes[model] = _vote_relations(model)
+    return polls, choices, votes
+
+def get_tables():
+    """
+    (polls, choices, votes) dicts of model -> relations, or None while the
+    app cache is loading. Treat them as read only.
+    """
+    global _tables
+    tables = _tables
+    if tables is None and app_cache.app_cache_ready():
+        with _lock:
+            if _tables is None:
+                generation = _generation
+                tables = _build()
+                # don't publish tables a model prepared meanwhile made stale
+                if generation == _generation:
+                    _tables = tables
+            else:
+                tables = _tables
+    return tables
+
+def _lookup(index, model, fallback):
+    tables = get_tables()
+    if tables is not None:
+        try:
+            return tables[index][model]
+        except KeyError:
+            pass
+    return fallback(model)
+
+def poll_relations(model):
+    return _lookup(0, model, _poll_relations)
+
+def choice_relations(model):
+    return _lookup(1, model, _choice_relations)
+
+def vote_relations(model):
+    return _lookup(2, model, _vote_relations)
+
+def clear_registry(**kwargs):
+    global _tables, _generation
+    with _lock:
+        _tables = None
+        _generation += 1
+
+class_prepared.connect(clear_registry, dispatch_uid='pollup_clear_registry')
@@ -4,7 +4,37 @@ from django.conf import settings
 
 
 DEFAULT_SETTINGS = {
-
+    # queue PollBase.vote() in memory and write the votes in batches
+    'VOTE_BUFFER': False,
+    # number of buffered votes that triggers a flush
+    'VOTE_BUFFER_SIZE': 500,
+    # seconds between background flushes, 0 to only flush on size/exit
+    'VOTE_BUFFER_INTERVAL': 1.0,
+    # cache alias (or get_cache backend) for PollBase.results(), None to disable
+    'RESULTS_CACHE': None,
+    # seconds a cached result lives
+    'RESULTS_CACHE_TIMEOUT': 300,
+    # cache alias (or get_cache backend) for the template tags' fragments, None to disable
+    'FRAGMENT_CACHE': None,
+    # seconds a cached fragment lives
+    'FRAGMENT_CACHE_TIMEOUT': 300,
+    # time hot paths and count their queries, see pollup.instrumentation
+    'INSTRUMENTATION': False,
+    # count votes into VoteRollup buckets as they are written, instead of
+    # with the pollup_rollup command
+    'ROLLUP_ON_VOTE': False,
+    # bucket sizes rolled up
+    'ROLLUP_RESOLUTIONS': ('minute', 'hour', 'day'),
+    # seconds the avote()/atally()/achoices() worker waits to batch calls
+    'BATCH_DELAY': 0.005,
+    # seconds ScheduledPollManager.open_ids() is cached
+    'OPEN_POLLS_CACHE_TIMEOUT': 5,
+    # seconds pollup.views keeps its slug -> poll and choice id maps
+    'LOOKUP_CACHE_TIMEOUT': 60,
+    # seconds between the live tally publisher's counts
+    'STREAM_INTERVAL': 1.0,
+    # seconds of silence after which a stream sends a keepalive comment
+    'STREAM_KEEPALIVE': 15,
 }
 
 USER_SETTINGS = DEFAULT_SETTINGS.copy()
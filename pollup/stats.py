@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Score distributions of ScorePollMixin polls, computed with NumPy.
+
+NumPy is optional; it is only imported by the functions in this module. The
+scores are streamed from the database into one array per vote model and all
+statistics are computed per choice with vectorized operations.
+"""
+import math
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# two-sided 95% normal quantile
+Z_95 = 1.959963984540054
+
+
+def _require_numpy():
+    if numpy is None:
+        raise ImportError("pollup.stats needs NumPy, install it with `pip install numpy`.")
+
+
+def score_arrays(poll):
+    """
+    {choice_model: (choice_pks, scores)} with one pair of NumPy arrays per
+    vote model of ``poll``.
+    """
+    _require_numpy()
+    arrays = {}
+    for vote_model in poll.votes_models():
+        qs = vote_model._default_manager.filter(poll=poll).order_by()
+        count = qs.count()
+        rows = qs.values_list('choice', 'weight').iterator()
+        data = numpy.fromiter(rows, dtype=[('choice', numpy.int64), ('weight', numpy.float64)], count=count)
+        arrays[vote_model.choice_model()] = (data['choice'], data['weight'])
+    return arrays
+
+
+def score_distribution(poll, bins=10, confidence=Z_95):
+    """
+    Per choice statistics of the scores of ``poll``:
+    {(choice_model, choice_pk): {'count', 'mean', 'std', 'ci', 'histogram'}}
+    where ``ci`` is the (low, high) normal confidence interval of the mean and
+    ``histogram`` is (counts, bin_edges) over the poll's score range.
+    """
+    _require_numpy()
+    distribution = {}
+    arrays = score_arrays(poll)
+    all_scores = [scores for pks, scores in arrays.values() if len(scores)]
+    if not all_scores:
+        return distribution
+    low = min([scores.min() for scores in all_scores])
+    high = max([scores.max() for scores in all_scores])
+    for choice_model, (pks, scores) in arrays.items():
+        if not len(pks):
+            continue
+        order = numpy.argsort(pks, kind='mergesort')
+        pks, scores = pks[order], scores[order]
+        unique_pks, starts, counts = numpy.unique(pks, return_index=True, return_counts=True)
+        sums = numpy.add.reduceat(scores, starts)
+        means = sums / counts
+        squares = numpy.add.reduceat((scores - numpy.repeat(means, counts)) ** 2, starts)
+        stds = numpy.sqrt(squares / numpy.maximum(counts - 1, 1))
+        for pk, start, count, mean, std in zip(unique_pks, starts, counts, means, stds):
+            margin = confidence * std / math.sqrt(count)
+            distribution[(choice_model, int(pk))] = {
+                'count': int(count),
+                'mean': float(mean),
+                'std': float(std),
+                'ci': (float(mean - margin), float(mean + margin)),
+                'histogram': numpy.histogram(scores[start:start + count], bins=bins, range=(low, high)),
+            }
+    return distribution
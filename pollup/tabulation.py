@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Tabulation of ranked ballots.
+
+Ballots are kept in a ``BallotBox`` as one flat array of candidate indexes plus
+an array of offsets, so a million ballots cost a few bytes per ranking instead
+of a Python list each. ``instant_runoff`` keeps, for every ballot, a pointer to
+its highest ranked candidate still in the race and a pile of ballot indexes per
+candidate. Eliminating a candidate only moves the ballots on that candidate's
+pile, so a whole count touches each ranking once.
+"""
+from array import array
+from collections import namedtuple
+
+RunoffResult = namedtuple('RunoffResult', ['winner', 'rounds', 'eliminated'])
+
+
+class BallotBox(object):
+    def __init__(self, candidates=()):
+        self.candidates = []
+        self.index = {}
+        # candidate indexes of every ballot, one ballot after the other
+        self.rankings = array('i')
+        # ballot n is rankings[offsets[n]:offsets[n + 1]]
+        self.offsets = array('l', [0])
+        for candidate in candidates:
+            self._candidate_index(candidate)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def _candidate_index(self, candidate):
+        try:
+            return self.index[candidate]
+        except KeyError:
+            index = self.index[candidate] = len(self.candidates)
+            self.candidates.append(candidate)
+            return index
+
+    def add(self, ranking):
+        # ranking lists candidates most preferred first, repeats are ignored
+        indexes = []
+        for candidate in ranking:
+            index = self._candidate_index(candidate)
+            if index not in indexes:
+                indexes.append(index)
+        self.rankings.extend(indexes)
+        self.offsets.append(len(self.rankings))
+
+
+def instant_runoff(box):
+    """
+    Count ``box`` by instant runoff. Returns a RunoffResult of the winning
+    candidate (None without votes), the per-round counts of the candidates
+    still in the race and the candidates in order of elimination.
+
+    Ties for last place eliminate the candidate with fewer first preferences,
+    then the one added to the box last.
+    """
+    rankings, offsets = box.rankings, box.offsets
+    n_candidates, n_ballots = len(box.candidates), len(box)
+    counts = array('l', [0]) * n_candidates
+    position = array('l', offsets[:-1])
+    piles = [array('l') for i in range(n_candidates)]
+    for ballot in range(n_ballots):
+        if position[ballot] < offsets[ballot + 1]:
+            candidate = rankings[position[ballot]]
+            piles[candidate].append(ballot)
+            counts[candidate] += 1
+    first_preferences = array('l', counts)
+
+    running = bytearray([1]) * n_candidates
+    remaining = n_candidates
+    rounds, eliminated = [], []
+    while remaining:
+        active = [i for i in range(n_candidates) if running[i]]
+        rounds.append(dict((box.candidates[i], counts[i]) for i in active))
+        total = sum([counts[i] for i in active])
+        leader = max(active, key=lambda i: (counts[i], -i))
+        if total == 0:
+            return RunoffResult(None, rounds, eliminated)
+        if remaining == 1 or counts[leader] * 2 > total:
+            return RunoffResult(box.candidates[leader], rounds, eliminated)
+
+        loser = min(active, key=lambda i: (counts[i], first_preferences[i], -i))
+        running[loser] = 0
+        remaining -= 1
+        eliminated.append(box.candidates[loser])
+        # move the loser's ballots to their next choice still running
+        for ballot in piles[loser]:
+            pos, end = position[ballot] + 1, offsets[ballot + 1]
+            while pos < end and not running[rankings[pos]]:
+                pos += 1
+            position[ballot] = pos
+            if pos < end:
+                piles[rankings[pos]].append(ballot)
+                counts[rankings[pos]] += 1
+        piles[loser] = None
+        counts[loser] = 0
+    return RunoffResult(None, rounds, eliminated)
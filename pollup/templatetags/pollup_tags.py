@@ -1,5 +1,102 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import hashlib
+
 from django import template
+from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
+
+from pollup.cache import fragment_key, get_fragment, set_fragment, poll_versions, get_fragment_cache
+from pollup.instrumentation import instrumented
+from pollup.models import GenericChoiceBase, choice_token, get_content_type
+from pollup.registry import get_tables
 
 register = template.Library()
+
+
+def cached_fragment(name, polls, template_name, render, *parts):
+    """
+    Render with ``render()`` and cache the result under a key carrying the
+    versions of ``polls``, so a vote in any of them retires the fragment.
+    """
+    if get_fragment_cache() is None:
+        return render()
+    versions = []
+    by_model = {}
+    for poll in polls:
+        by_model.setdefault(poll.__class__, []).append(poll.pk)
+    for poll_model, pks in by_model.items():
+        found = poll_versions(poll_model, *pks)
+        versions.extend('%s.%s:%s:%s' % (poll_model._meta.app_label, poll_model._meta.module_name,
+            pk, found[pk]) for pk in pks)
+    digest = hashlib.md5('|'.join(versions)).hexdigest()
+    key = fragment_key(name, template_name, digest, *parts)
+    html = get_fragment(key)
+    if html is None:
+        html = render()
+        set_fragment(key, html)
+    return html
+
+def results_for(polls):
+    # [(poll, results), ...] in the order given, loaded per poll model
+    by_model = {}
+    for poll in polls:
+        by_model.setdefault(poll.__class__, []).append(poll)
+    results = {}
+    for poll_model, model_polls in by_model.items():
+        for pk, poll_results in poll_model.results_many(model_polls).items():
+            results[(poll_model, pk)] = poll_results
+    return [(poll, results[(poll.__class__, poll.pk)]) for poll in polls]
+
+@instrumented('polls_for_object')
+def polls_for_object(obj):
+    # the polls ``obj`` is a choice in, one query per choice model that can point at it
+    polls, seen = [], set()
+    for choice_model in get_tables()[1]:
+        if not issubclass(choice_model, GenericChoiceBase):
+            target = choice_model._meta.get_field('content_object').rel.to
+            if not isinstance(obj, target):
+                continue
+        for poll in choice_model.choices_for(obj.__class__, obj):
+            if (poll.__class__, poll.pk) not in seen:
+                seen.add((poll.__class__, poll.pk))
+                polls.append(poll)
+    return polls
+
+
+@register.simple_tag
+def poll_results(poll, template_name='pollup/poll_results.html'):
+    """
+    {% poll_results poll [template_name] %}
+    """
+    def render():
+        poll_with_results = results_for([poll])
+        return render_to_string(template_name, {'poll': poll, 'results': poll_with_results[0][1]})
+    return cached_fragment('results', [poll], template_name, render)
+
+@register.simple_tag
+def polls_for(obj, template_name='pollup/polls_for.html'):
+    """
+    {% polls_for object [template_name] %}
+
+    Results of every poll ``object`` is a choice in.
+    """
+    polls = polls_for_object(obj)
+    def render():
+        return render_to_string(template_name, {'object': obj, 'polls': results_for(polls)})
+    return cached_fragment('polls_for', polls, template_name, render, get_content_type(obj).pk, obj.pk)
+
+@register.simple_tag(takes_context=True)
+def poll_form(context, poll, action='', template_name='pollup/poll_form.html'):
+    """
+    {% poll_form poll [action] [template_name] %}
+
+    The choices are cached, the CSRF token is filled in on every render.
+    """
+    def render():
+        choices = poll.__class__.prefetch_results([poll])[0].choices()
+        return render_to_string('pollup/poll_form_choices.html', {'poll': poll,
+            'choices': [(choice_token(choice), choice) for choice in choices]})
+    fields = cached_fragment('form', [poll], 'pollup/poll_form_choices.html', render)
+    return render_to_string(template_name, {'poll': poll, 'action': action,
+        'fields': mark_safe(fields), 'csrf_token': context.get('csrf_token', '')})
@@ -1,11 +1,701 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-from django.test import TestCase
+import csv
+import itertools
+import json
+import os
+import tempfile
+from datetime import timedelta
+from StringIO import StringIO
+
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.core.urlresolvers import reverse
+from django.db import connection, transaction, IntegrityError
+from django.db.models.signals import post_save
+from django.http import Http404
+from django.template import Context, Template
+from django.test import TestCase, TransactionTestCase
+from django.test.client import RequestFactory
+from django.utils import timezone
+
+from pollup import batching, buffer as buffer_module, publisher as publisher_module, settings
+from pollup.cache import get_fragment_cache, get_results_cache, set_results
+from pollup.instrumentation import get_stats, reset_stats, hot_path_timed
+from pollup.buffer import VoteBuffer
+from pollup.publisher import TallyPublisher
+from pollup.registry import clear_registry, get_tables, poll_relations, vote_relations
+from pollup.tabulation import BallotBox, instant_runoff
+from pollup.templatetags.pollup_tags import polls_for_object
+from pollup.lookups import clear_lookups, lookup_choice, lookup_poll
+from pollup.views import stream
+from pollup.models import (Poll, PollChoice, PollChoiceVote, VoteRollup, RollupMark, VoterRegistration,
+    choice_token, clear_content_type_cache, get_content_type, poll_finalized)
+
+
+class TabulationTest(TestCase):
+    def test_instant_runoff(self):
+        box = BallotBox()
+        for ballot in [['a']] * 4 + [['b', 'c']] * 3 + [['c', 'b', 'c']] * 2:
+            box.add(ballot)
+        self.assertEqual(len(box), 9)
+        result = instant_runoff(box)
+        self.assertEqual(result.winner, 'b')
+        self.assertEqual(result.rounds, [{'a': 4, 'b': 3, 'c': 2}, {'a': 4, 'b': 5}])
+        self.assertEqual(result.eliminated, ['c'])
+
+    def test_exhausted_ballots_and_ties(self):
+        box = BallotBox(['a', 'b', 'c', 'd'])
+        for ballot in [['a'], ['a'], ['b'], ['c', 'd'], ['d', 'b']]:
+            box.add(ballot)
+        result = instant_runoff(box)
+        # d and c tie on first preferences, d was added last and goes first
+        # then b has fewer first preferences than a
+        self.assertEqual(result.eliminated, ['d', 'c', 'b'])
+        self.assertEqual(result.rounds[-2:], [{'a': 2, 'b': 2}, {'a': 2}])
+        self.assertEqual(result.winner, 'a')
+
+    def test_empty(self):
+        self.assertEqual(instant_runoff(BallotBox()).winner, None)
+        self.assertEqual(instant_runoff(BallotBox(['a'])).winner, None)
 
 
 class pollupTest(TestCase):
     """
     Tests for pollup
     """
+    def setUp(self):
+        self.poll = Poll.objects.create(title="Best", slug="best")
+        self.voters = [User.objects.create(username="voter%d" % i) for i in range(3)]
+        self.red = PollChoice.objects.create(poll=self.poll, content_object=self.voters[0])
+        self.blue = PollChoice.objects.create(poll=self.poll, content_object=self.voters[1])
+
     def test_pollup(self):
         pass
+
+    def test_vote_counters(self):
+        PollChoiceVote.objects.create(poll=self.poll, choice=self.blue, voter=self.voters[0])
+        vote = PollChoiceVote.objects.create(poll=self.poll, choice=self.blue, voter=self.voters[1])
+        PollChoiceVote.objects.create(poll=self.poll, choice=self.red, voter=self.voters[2])
+        self.assertEqual(PollChoice.objects.get(pk=self.blue.pk).vote_count, 2)
+        self.assertEqual(self.poll.winner, self.blue)
+        self.assertEqual(self.poll.loser, self.red)
+
+        vote.delete()
+        self.assertEqual(PollChoice.objects.get(pk=self.blue.pk).vote_count, 1)
+        self.assertEqual([c.vote_count for c in self.poll.standings()], [1, 1])
+
+    def test_cascade_delete(self):
+        for voter in self.voters:
+            self.poll.vote(voter, self.blue)
+        self.poll.vote(None, self.red, voter_ip='10.0.0.1')
+        # the votes' bookkeeping is one registry DELETE for the whole choice
+        with self.assertNumQueries(5):
+            self.blue.delete()
+        self.assertEqual(PollChoiceVote.objects.count(), 1)
+        self.poll.vote(self.voters[0], self.red)
+        self.assertEqual(PollChoice.objects.get(pk=self.red.pk).vote_count, 2)
+        self.poll.delete()
+        self.assertEqual(VoterRegistration.objects.count(), 0)
+
+    def test_no_choices(self):
+        poll = Poll.objects.create(title="Empty", slug="empty")
+        self.assertEqual(poll.standings(), [])
+        self.assertEqual(poll.winner, None)
+        self.assertEqual(poll.loser, None)
+
+    def test_tally(self):
+        PollChoiceVote.objects.create(poll=self.poll, choice=self.blue, voter=self.voters[0])
+        PollChoiceVote.objects.create(poll=self.poll, choice=self.blue, voter=self.voters[1])
+        PollChoiceVote.objects.create(poll=self.poll, choice=self.red, voter=self.voters[2])
+        other = Poll.objects.create(title="Other", slug="other")
+        with self.assertNumQueries(1):
+            tallies = Poll.tally_many([self.poll, other])
+        self.assertEqual(tallies[self.poll.pk], {
+            (PollChoice, self.blue.pk): 2,
+            (PollChoice, self.red.pk): 1,
+        })
+        self.assertEqual(tallies[other.pk], {})
+        self.assertEqual(self.poll.tally(), tallies[self.poll.pk])
+
+    def test_refresh_vote_counts(self):
+        PollChoiceVote.objects.create(poll=self.poll, choice=self.blue, voter=self.voters[0])
+        PollChoice.objects.filter(pk=self.blue.pk).update(vote_count=7)
+        self.poll.refresh_vote_counts()
+        self.assertEqual(PollChoice.objects.get(pk=self.blue.pk).vote_count, 1)
+
+    def test_cast_votes(self):
+        PollChoiceVote.objects.create(poll=self.poll, choice=self.red, voter=self.voters[0])
+        other = Poll.objects.create(title="Other", slug="other")
+        stray = PollChoice.objects.create(poll=other, content_object=self.voters[2])
+        batch = [
+            (self.voters[0], '10.0.0.1', self.blue),  # already voted
+            (self.voters[1], '10.0.0.2', self.blue),
+            (self.voters[1], '10.0.0.3', self.red),  # twice in this batch
+            (None, '10.0.0.2', self.red),  # one vote per anonymous IP
+            (None, '10.0.0.2', self.blue),
+            (self.voters[2], '10.0.0.5', stray),
+        ]
+        accepted, rejected = self.poll.cast_votes(batch)
+        self.assertEqual(len(accepted), 2)
+        self.assertEqual([row for row, reason in rejected], [batch[0], batch[2], batch[4], batch[5]])
+        self.assertEqual(self.poll.tally(), {
+            (PollChoice, self.red.pk): 2,
+            (PollChoice, self.blue.pk): 1,
+        })
+        self.assertEqual(PollChoice.objects.get(pk=self.red.pk).vote_count, 2)
+
+    def test_vote_dedup_constraint(self):
+        self.assertEqual(PollChoiceVote._meta.unique_together, (('poll', 'dedup_key'),))
+        # no pre-check query: registry and vote INSERTs, the counter UPDATE
+        with self.assertNumQueries(3):
+            vote = self.poll.vote(self.voters[0], self.blue, voter_ip='10.0.0.1')
+        self.assertEqual(vote.dedup_key, u'voter:%s' % self.voters[0].pk)
+        self.assertRaises(ValidationError, self.poll.vote, self.voters[0], self.red)
+        self.assertEqual(PollChoice.objects.get(pk=self.red.pk).vote_count, 0)
+        # polls without the rules store no key
+        self.poll.one_vote_per_user = self.poll.one_vote_per_ip = False
+        self.assertEqual(self.poll.vote(self.voters[0], self.red).dedup_key, None)
+        self.assertEqual(self.poll.vote(self.voters[0], self.red).dedup_key, None)
+
+    def test_vote(self):
+        vote = self.poll.vote(self.voters[0], self.blue, voter_ip='10.0.0.1')
+        self.assertEqual(vote.choice, self.blue)
+        vote = self.poll.vote(self.voters[1], self.voters[0])
+        self.assertEqual(vote.choice, self.red)
+        self.assertRaises(ValidationError, self.poll.vote, self.voters[0], self.red)
+        self.assertRaises(ValidationError, self.poll.vote, self.voters[2], self.voters[2])
+
+    def test_batched_calls(self):
+        # drained in-process here; the worker thread would use another connection
+        batcher = batching.Batcher(threaded=False)
+        old_batcher, batching._batcher = batching._batcher, batcher
+        try:
+            first = self.poll.avote(self.voters[0], self.blue)
+            again = self.poll.avote(self.voters[0], self.red)
+            second = self.poll.avote(self.voters[1], self.voters[0])
+            stray = self.poll.avote(self.voters[2], self.voters[2])
+            self.assertFalse(first.done())
+            self.assertEqual(PollChoiceVote.objects.count(), 0)
+            called = []
+            first.add_done_callback(called.append)
+            self.assertEqual(batcher.flush(), 4)
+            self.assertEqual(called, [first])
+            self.assertEqual(first.result().choice, self.blue)
+            self.assertEqual(second.result().choice, self.red)
+            self.assertRaises(ValidationError, again.result)
+            self.assertTrue(isinstance(stray.exception(), ValidationError))
+
+            tally, choices = self.poll.atally(), self.poll.achoices()
+            batcher.flush()
+            self.assertEqual(tally.result(), {(PollChoice, self.red.pk): 1, (PollChoice, self.blue.pk): 1})
+            self.assertEqual(choices.result(), [self.red, self.blue])
+        finally:
+            batching._batcher = old_batcher
+
+    def test_voting_window(self):
+        now = timezone.now()
+        upcoming = Poll.objects.create(title="Upcoming", slug="upcoming", voting_opens_on=now + timedelta(days=1))
+        closed = Poll.objects.create(title="Closed", slug="closed", voting_opens_on=now - timedelta(days=2),
+            voting_closes_on=now - timedelta(days=1))
+        late = PollChoice.objects.create(poll=closed, content_object=self.voters[0])
+        self.assertEqual(list(Poll.objects.active()), [self.poll])
+        self.assertEqual(list(Poll.objects.upcoming()), [upcoming])
+        self.assertEqual(list(Poll.objects.closed()), [closed])
+        self.assertEqual(Poll.objects.open_ids(), frozenset([self.poll.pk]))
+        with self.assertNumQueries(0):
+            Poll.objects.open_ids()
+        upcoming.voting_opens_on = now
+        upcoming.save()
+        self.assertEqual(Poll.objects.open_ids(), frozenset([self.poll.pk, upcoming.pk]))
+
+        # refused from the loaded fields, without a query
+        with self.assertNumQueries(0):
+            self.assertRaises(ValidationError, closed.vote, self.voters[0], late)
+        accepted, rejected = closed.cast_votes([(self.voters[0], '', late)])
+        self.assertEqual((accepted, len(rejected)), ([], 1))
+
+        PollChoiceVote.objects.create(poll=closed, choice=late)
+        PollChoice.objects.filter(pk=late.pk).update(vote_count=5)
+        finalized = []
+        def receiver(sender, poll, **kwargs):
+            finalized.append(poll)
+        poll_finalized.connect(receiver)
+        try:
+            call_command('pollup_finalize', verbosity=0)
+        finally:
+            poll_finalized.disconnect(receiver)
+        self.assertEqual(finalized, [closed])
+        self.assertTrue(Poll.objects.get(pk=closed.pk).finalized_on is not None)
+        self.assertEqual(PollChoice.objects.get(pk=late.pk).vote_count, 1)
+        self.assertEqual(Poll.objects.finalize_closed(), 0)
+
+    def test_result_snapshots(self):
+        now = timezone.now()
+        self.poll.cast_votes([(self.voters[0], '', self.red), (self.voters[1], '', self.red),
+            (self.voters[2], '', self.blue)])
+        self.poll.voting_closes_on = now - timedelta(hours=1)
+        self.poll.save()
+        call_command('pollup_snapshot', verbosity=0)
+        poll = Poll.objects.get(pk=self.poll.pk)
+        self.assertTrue(poll.finalized_on is not None)
+        self.assertEqual([(row.choice_id, row.count, row.rank, row.label) for row in poll.snapshot()],
+            [(self.red.pk, 2, 1, unicode(self.voters[0])), (self.blue.pk, 1, 2, unicode(self.voters[1]))])
+
+        # frozen: later changes to the vote rows don't show
+        PollChoiceVote.objects.filter(choice=self.red).delete()
+        # the snapshot is loaded already, the winner needs the choices
+        with self.assertNumQueries(1):
+            self.assertEqual(poll.tally(), {(PollChoice, self.red.pk): 2, (PollChoice, self.blue.pk): 1})
+            self.assertEqual(poll.winner, self.red)
+        self.assertEqual(poll.results()['loser'], self.blue)
+        call_command('pollup_snapshot', verbosity=0)
+        self.assertEqual(Poll.objects.get(pk=poll.pk).tally()[(PollChoice, self.red.pk)], 2)
+        call_command('pollup_snapshot', all=True, verbosity=0)
+        self.assertEqual(Poll.objects.get(pk=poll.pk).tally(), {(PollChoice, self.red.pk): 0,
+            (PollChoice, self.blue.pk): 1})
+
+    def test_vote_buffer(self):
+        vote_buffer = VoteBuffer(size=3, interval=0)
+        old_buffer, buffer_module._vote_buffer = buffer_module._vote_buffer, vote_buffer
+        settings.VOTE_BUFFER = True
+        try:
+            self.assertEqual(self.poll.vote(self.voters[0], self.blue), None)
+            self.assertRaises(ValidationError, self.poll.vote, self.voters[0], self.red)
+            self.poll.vote(self.voters[1], self.red)
+            self.assertEqual(PollChoiceVote.objects.count(), 0)
+            self.assertEqual(len(vote_buffer), 2)
+            self.poll.vote(self.voters[2], self.red)  # fills the buffer
+            self.assertEqual(len(vote_buffer), 0)
+            self.assertEqual(PollChoiceVote.objects.count(), 3)
+            # persisted votes are still checked, without holding the buffer's lock
+            held = []
+            existing = self.poll.existing_vote_dedup_keys
+            def checking(keys):
+                held.append(vote_buffer.lock._is_owned())
+                return existing(keys)
+            self.poll.existing_vote_dedup_keys = checking
+            self.assertRaises(ValidationError, self.poll.vote, self.voters[1], self.blue)
+            self.assertEqual(held, [False])
+            self.assertEqual(buffer_module.flush(), 0)
+        finally:
+            settings.VOTE_BUFFER = False
+            buffer_module._vote_buffer = old_buffer
+        self.assertEqual(self.poll.winner, self.red)
+
+    def test_content_type_cache(self):
+        PollChoice.lookup_kwargs(self.voters[0])
+        ContentType.objects.clear_cache()
+        with self.assertNumQueries(0):
+            kwargs = PollChoice.lookup_kwargs(self.voters[1])
+            PollChoice.bulk_lookup_kwargs(self.voters)
+            PollChoice.choices_for(User, self.voters[1])
+        self.assertEqual(kwargs['content_type'], ContentType.objects.get_for_model(User))
+        clear_content_type_cache()
+        ContentType.objects.clear_cache()
+        with self.assertNumQueries(1):
+            PollChoice.lookup_kwargs(self.voters[1])
+
+    def test_registry(self):
+        clear_registry()
+        relations = poll_relations(Poll)
+        self.assertEqual(relations.choice_models, (PollChoice,))
+        self.assertEqual(relations.vote_models, (PollChoiceVote,))
+        self.assertTrue(poll_relations(Poll) is relations)
+        self.assertEqual(vote_relations(PollChoiceVote), (Poll, PollChoiceVote.poll.field.rel.related_name,
+            PollChoice, 'votes'))
+        self.assertEqual(PollChoice.vote_model(), PollChoiceVote)
+        self.assertTrue(vote_relations(PollChoiceVote) is get_tables()[2][PollChoiceVote])
+        clear_registry()
+        self.assertTrue(get_tables() is not None)
+        self.assertFalse(poll_relations(Poll) is relations)
+
+    def test_prefetch_results(self):
+        other = Poll.objects.create(title="Other", slug="other")
+        PollChoice.objects.create(poll=other, content_object=self.voters[2])
+        PollChoiceVote.objects.create(poll=self.poll, choice=self.blue, voter=self.voters[0])
+        with self.assertNumQueries(2):
+            self.assertEqual(self.poll.choices_objects(), self.voters[:2])
+        with self.assertNumQueries(3):
+            polls = Poll.prefetch_results(Poll.objects.filter(pk__in=[self.poll.pk, other.pk]).order_by('pk'))
+        with self.assertNumQueries(0):
+            self.assertEqual(polls[0].choices_objects(), self.voters[:2])
+            self.assertEqual(polls[0].winner, self.blue)
+            self.assertEqual(polls[1].choices_objects(), [self.voters[2]])
+            self.assertEqual(polls[1].choices()[0].poll, polls[1])
+
+    def test_results_cache(self):
+        settings.RESULTS_CACHE = 'locmem://'
+        try:
+            get_results_cache().clear()
+            PollChoiceVote.objects.create(poll=self.poll, choice=self.blue, voter=self.voters[0])
+            results = self.poll.results()
+            self.assertEqual(results['winner'], self.blue)
+            with self.assertNumQueries(0):
+                results = Poll(pk=self.poll.pk).results()
+            self.assertEqual(results['tally'], {(PollChoice, self.blue.pk): 1})
+            self.assertEqual(results['standings'][0].content_object, self.voters[1])
+
+            # new votes, bulk votes and new choices drop the cached results
+            PollChoiceVote.objects.create(poll=self.poll, choice=self.red, voter=self.voters[1])
+            self.assertEqual(self.poll.results()['tally'][(PollChoice, self.red.pk)], 1)
+            # a reader refilling the cache before the commit is invalidated after it
+            stale = self.poll.results()
+            write_votes = self.poll._write_votes
+            def racing_write(votes, **kwargs):
+                write_votes(votes, **kwargs)
+                set_results(Poll, self.poll.pk, stale)
+            self.poll._write_votes = racing_write
+            self.poll.cast_votes([(self.voters[2], '', self.red)])
+            del self.poll._write_votes
+            self.assertEqual(self.poll.results()['tally'][(PollChoice, self.red.pk)], 2)
+            self.assertEqual(self.poll.results()['winner'], self.red)
+            # the same for a vote saved directly
+            stale = self.poll.results()
+            def racing_save(sender, **kwargs):
+                set_results(Poll, self.poll.pk, stale)
+            post_save.connect(racing_save, sender=PollChoiceVote)
+            try:
+                PollChoiceVote(poll=self.poll, choice=self.blue, voter_ip='10.0.0.1').save()
+            finally:
+                post_save.disconnect(racing_save, sender=PollChoiceVote)
+            self.assertEqual(self.poll.results()['tally'][(PollChoice, self.blue.pk)], 2)
+            green = PollChoice.objects.create(poll=self.poll, content_object=self.voters[2])
+            self.assertEqual(len(self.poll.results()['standings']), 3)
+            green.delete()
+            self.assertEqual(len(self.poll.results()['standings']), 2)
+        finally:
+            get_results_cache().clear()
+            settings.RESULTS_CACHE = None
+
+    def test_template_tags(self):
+        settings.FRAGMENT_CACHE = 'locmem://'
+        try:
+            get_fragment_cache().clear()
+            PollChoiceVote.objects.create(poll=self.poll, choice=self.blue, voter=self.voters[0])
+            results = Template("{% load pollup_tags %}{% poll_results poll %}")
+            context = Context({'poll': self.poll})
+            html = results.render(context)
+            self.assertTrue(html.index(unicode(self.voters[1])) < html.index(unicode(self.voters[0])))
+            with self.assertNumQueries(0):
+                self.assertEqual(results.render(context), html)
+            self.poll.vote(self.voters[1], self.red)
+            self.poll.vote(self.voters[2], self.red)
+            self.assertNotEqual(results.render(context), html)
+
+            polls_for = Template("{% load pollup_tags %}{% polls_for user %}")
+            html = polls_for.render(Context({'user': self.voters[1]}))
+            self.assertTrue('id="poll-%s-results"' % self.poll.pk in html)
+            with self.assertNumQueries(1):
+                self.assertEqual(polls_for.render(Context({'user': self.voters[1]})), html)
+            self.assertFalse('poll-' in polls_for.render(Context({'user': self.voters[2]})))
+
+            form = Template("{% load pollup_tags %}{% poll_form poll '/vote/' %}")
+            html = form.render(Context({'poll': self.poll, 'csrf_token': 'token1'}))
+            self.assertTrue('value="%s"' % choice_token(self.red) in html)
+            with self.assertNumQueries(0):
+                html = form.render(Context({'poll': self.poll, 'csrf_token': 'token2'}))
+            self.assertTrue('value="token2"' in html)
+        finally:
+            get_fragment_cache().clear()
+            settings.FRAGMENT_CACHE = None
+
+    def test_instrumentation(self):
+        timed = []
+        def receiver(sender, path, duration, queries, **kwargs):
+            timed.append((path, queries))
+        hot_path_timed.connect(receiver)
+        get_content_type(Poll)  # the voter registry's content type lookup
+        reset_stats()
+        logged = len(connection.queries)
+        settings.INSTRUMENTATION = True
+        try:
+            self.poll.choices_objects()
+            self.poll.votes()
+            PollChoiceVote(poll=self.poll, choice=self.red, voter=self.voters[0]).validate_unique()
+            self.assertEqual(polls_for_object(self.voters[0]), [self.poll])
+        finally:
+            settings.INSTRUMENTATION = False
+            hot_path_timed.disconnect(receiver)
+        # the debug cursor's log is trimmed back when it was off
+        self.assertEqual(len(connection.queries), logged)
+        self.assertEqual(timed[:4], [('choices', 1), ('choices_objects', 2), ('votes', 1), ('validate_unique', 1)])
+        # one query per choice model that can point at a user
+        self.assertEqual(timed[4][0], 'polls_for_object')
+        self.assertTrue(timed[4][1] >= 1)
+        stats = get_stats()
+        self.assertEqual(stats['choices']['calls'], 1)
+        self.assertEqual(stats['choices_objects']['queries'], 2)
+        self.poll.votes()
+        self.assertEqual(get_stats()['votes']['calls'], 1)
+
+    def test_export(self):
+        other = Poll.objects.create(title="Other", slug="other")
+        green = PollChoice.objects.create(poll=other, content_object=self.voters[2])
+        self.poll.cast_votes([(self.voters[0], '10.0.0.1', self.red), (None, '10.0.0.2', self.blue)])
+        other.vote(self.voters[0], green)
+
+        out = StringIO()
+        call_command('pollup_export', chunk_size=1, stdout=out)
+        rows = list(csv.DictReader(StringIO(out.getvalue())))
+        self.assertEqual([(row['poll_id'], row['choice_id'], row['voter_id'], row['voter_ip']) for row in rows], [
+            (str(self.poll.pk), str(self.red.pk), str(self.voters[0].pk), '10.0.0.1'),
+            (str(self.poll.pk), str(self.blue.pk), '', '10.0.0.2'),
+            (str(other.pk), str(green.pk), str(self.voters[0].pk), ''),
+        ])
+        self.assertEqual(rows[0]['vote_type'], 'pollup.pollchoicevote')
+
+        out = StringIO()
+        call_command('pollup_export', 'pollup.poll:%s' % other.pk, format='jsonl', objects=True, stdout=out)
+        rows = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual(len(rows), 1)
+        self.assertEqual((rows[0]['object_type'], rows[0]['object_id']), ('auth.user', self.voters[2].pk))
+
+    def test_import(self):
+        PollChoiceVote.objects.create(poll=self.poll, choice=self.red, voter=self.voters[0])
+        rows = [
+            {'poll_type': 'pollup.poll', 'poll_id': self.poll.pk, 'choice_type': 'pollup.pollchoice',
+                'choice_id': self.blue.pk, 'voter_id': self.voters[1].pk, 'time_stamp': '2012-05-01T10:00:00+00:00'},
+            {'poll_type': 'pollup.poll', 'poll_id': self.poll.pk, 'object_type': 'auth.user',
+                'object_id': self.voters[0].pk, 'voter_ip': '10.0.0.9'},
+            {'poll_type': 'pollup.poll', 'poll_id': self.poll.pk, 'object_type': 'auth.user',
+                'object_id': self.voters[1].pk, 'voter_id': self.voters[0].pk},  # already voted
+            {'poll_type': 'pollup.poll', 'poll_id': self.poll.pk, 'object_type': 'auth.user',
+                'object_id': self.voters[2].pk, 'voter_ip': '10.0.0.10'},  # not a choice
+        ]
+        fd, path = tempfile.mkstemp(suffix='.jsonl')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write('\n'.join(json.dumps(row) for row in rows[:3]) + '\n')
+            out = StringIO()
+            call_command('pollup_import', path, chunk_size=2, stdout=out)
+            self.assertTrue(out.getvalue().startswith('3 rows read, 2 votes imported, 1 rejected'))
+            self.assertEqual(self.poll.tally(), {(PollChoice, self.red.pk): 2, (PollChoice, self.blue.pk): 1})
+            vote = PollChoiceVote.objects.get(choice=self.blue)
+            self.assertEqual((vote.voter, vote.time_stamp.year), (self.voters[1], 2012))
+            self.assertEqual(PollChoice.objects.get(pk=self.blue.pk).vote_count, 1)
+
+            # appended rows: only the new one is read
+            with open(path, 'a') as f:
+                f.write(json.dumps(rows[3]) + '\n')
+            out = StringIO()
+            call_command('pollup_import', path, stdout=out)
+            self.assertTrue(out.getvalue().startswith('4 rows read, 0 votes imported, 1 rejected'))
+            self.assertEqual(PollChoiceVote.objects.count(), 3)
+        finally:
+            os.remove(path)
+
+    def test_rollups(self):
+        PollChoiceVote.objects.create(poll=self.poll, choice=self.blue, voter=self.voters[0])
+        PollChoiceVote.objects.create(poll=self.poll, choice=self.red, voter=self.voters[1])
+        call_command('pollup_rollup', verbosity=0)
+        PollChoiceVote.objects.create(poll=self.poll, choice=self.blue, voter=self.voters[2])
+        call_command('pollup_rollup', verbosity=0, chunk_size=1)
+        call_command('pollup_rollup', verbosity=0)  # nothing new, nothing counted twice
+
+        self.assertEqual(RollupMark.objects.get(vote_type=ContentType.objects.get_for_model(PollChoiceVote)).last_pk, PollChoiceVote.objects.latest('pk').pk)
+        with self.assertNumQueries(1):
+            trend = self.poll.trend('day')
+        self.assertEqual(len(trend), 1)
+        self.assertEqual(trend[0][1], {(PollChoice, self.blue.pk): 2, (PollChoice, self.red.pk): 1})
+        self.assertEqual(sum([sum(counts.values()) for bucket, counts in self.poll.trend('minute')]), 3)
+
+    def test_rollup_on_vote(self):
+        settings.ROLLUP_ON_VOTE = True
+        try:
+            PollChoiceVote.objects.create(poll=self.poll, choice=self.blue, voter=self.voters[0])
+            self.poll.cast_votes([(self.voters[1], '', self.blue), (self.voters[2], '', self.red)])
+        finally:
+            settings.ROLLUP_ON_VOTE = False
+        self.assertEqual(self.poll.trend('hour')[0][1][(PollChoice, self.blue.pk)], 2)
+        self.assertEqual(VoteRollup.objects.filter(resolution='day').count(), 2)
+
+    def test_rollup_insert_race(self):
+        manager = VoteRollup._default_manager
+        def racing_create(**kwargs):
+            # another vote's rollup row lands first
+            del manager.create
+            manager.create(**dict(kwargs, count=1))
+            return manager.create(**kwargs)
+        manager.create = racing_create
+        settings.ROLLUP_ON_VOTE = True
+        old_resolutions, settings.ROLLUP_RESOLUTIONS = settings.ROLLUP_RESOLUTIONS, ('day',)
+        try:
+            self.poll.vote(self.voters[0], self.blue)
+        finally:
+            settings.ROLLUP_ON_VOTE = False
+            settings.ROLLUP_RESOLUTIONS = old_resolutions
+            manager.__dict__.pop('create', None)
+        self.assertEqual(PollChoiceVote.objects.count(), 1)
+        self.assertEqual(VoteRollup.objects.get().count, 2)
+
+
+class VoteTransactionTest(TransactionTestCase):
+    # runs outside TestCase's managed transaction, where each query autocommits
+    def test_failed_vote_releases_voter(self):
+        poll = Poll.objects.create(title="Best", slug="best")
+        voter = User.objects.create(username="voter")
+        choice = PollChoice.objects.create(poll=poll, content_object=voter)
+        save_base = PollChoiceVote.save_base
+        def failing_save_base(self, *args, **kwargs):
+            raise IntegrityError("insert failed")
+        PollChoiceVote.save_base = failing_save_base
+        try:
+            self.assertRaises(ValidationError, poll.vote, voter, choice)
+        finally:
+            PollChoiceVote.save_base = save_base
+        self.assertEqual(VoterRegistration.objects.count(), 0)
+        poll.vote(voter, choice)
+        self.assertEqual(PollChoice.objects.get(pk=choice.pk).vote_count, 1)
+
+    def test_duplicate_keeps_callers_transaction(self):
+        poll = Poll.objects.create(title="Best", slug="best")
+        voter = User.objects.create(username="voter")
+        choice = PollChoice.objects.create(poll=poll, content_object=voter)
+        poll.vote(voter, choice)
+        with transaction.commit_on_success():
+            kept = Poll.objects.create(title="Kept", slug="kept")
+            # a duplicate that got past the pre-checks, as in a race
+            self.assertEqual(len(poll._insert_votes([poll._new_vote(choice, voter)])), 1)
+            self.assertRaises(ValidationError, poll._insert_votes, [poll._new_vote(choice, voter)], atomic=True)
+        self.assertTrue(Poll.objects.filter(pk=kept.pk).exists())
+        self.assertEqual(PollChoiceVote.objects.count(), 1)
+
+
+class ViewsTest(TestCase):
+    urls = 'pollup.urls'
+
+    def setUp(self):
+        clear_lookups()
+        self.poll = Poll.objects.create(title="Best", slug="best")
+        self.users = [User.objects.create(username="user%d" % i) for i in range(2)]
+        self.red = PollChoice.objects.create(poll=self.poll, content_object=self.users[0])
+        self.blue = PollChoice.objects.create(poll=self.poll, content_object=self.users[1])
+
+    def test_vote(self):
+        url = reverse('pollup_vote', kwargs={'slug': 'best'})
+        response = self.client.post(url, {'choice': choice_token(self.red), 'next': 'http://evil.example/'})
+        self.assertEqual(response['Location'], 'http://testserver' + reverse('pollup_results', kwargs={'slug': 'best'}))
+        # poll and choice come from the lookup maps: registry and vote INSERTs, counter UPDATE
+        with self.assertNumQueries(3):
+            response = self.client.post(url, {'choice': choice_token(self.blue)},
+                HTTP_X_REQUESTED_WITH='XMLHttpRequest', REMOTE_ADDR='10.0.0.1')
+        self.assertEqual(json.loads(response.content), {'ok': True})
+        response = self.client.post(url, {'choice': choice_token(self.blue)}, HTTP_ACCEPT='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.client.post(url, {'choice': '1-999'}).status_code, 400)
+        self.assertRaises(Http404, lookup_poll, Poll, 'nope')
+        self.assertEqual(self.client.get(url).status_code, 405)
+        self.assertEqual(self.poll.tally(), {(PollChoice, self.red.pk): 1, (PollChoice, self.blue.pk): 1})
+
+    def test_vote_require_auth(self):
+        self.poll.require_auth = True
+        self.poll.save()
+        url = reverse('pollup_vote', kwargs={'slug': 'best'})
+        self.assertEqual(self.client.post(url, {'choice': choice_token(self.red)}).status_code, 403)
+        response = self.client.post(url, {'choice': choice_token(self.red)}, HTTP_ACCEPT='application/json')
+        self.assertEqual((response.status_code, json.loads(response.content)['ok']), (403, False))
+        self.users[0].set_password('secret')
+        self.users[0].save()
+        self.client.login(username='user0', password='secret')
+        self.assertEqual(self.client.post(url, {'choice': choice_token(self.red)}).status_code, 302)
+        self.assertEqual(self.poll.tally(), {(PollChoice, self.red.pk): 1})
+
+    def test_lookups(self):
+        poll = lookup_poll(Poll, 'best')
+        self.assertEqual((poll, poll.title, poll.one_vote_per_user), (self.poll, "Best", True))
+        # a new instance per call, without a query
+        with self.assertNumQueries(0):
+            self.assertFalse(lookup_poll(Poll, 'best') is poll)
+        # saving a poll or choice drops what the lookups hold for it
+        poll = Poll.objects.create(title="New", slug="new")
+        self.assertEqual(lookup_poll(Poll, 'new'), poll)
+        self.assertRaises(ValidationError, lookup_choice, poll, choice_token(self.red))
+        choice = PollChoice.objects.create(poll=poll, content_object=self.users[0])
+        self.assertEqual(lookup_choice(poll, choice_token(choice)).pk, choice.pk)
+
+    def test_vote_next(self):
+        url = reverse('pollup_vote', kwargs={'slug': 'best'})
+        response = self.client.post(url, {'choice': choice_token(self.red), 'next': '/thanks/'})
+        self.assertEqual(response['Location'], 'http://testserver/thanks/')
+
+    def test_results(self):
+        url = reverse('pollup_results', kwargs={'slug': 'best'})
+        PollChoiceVote.objects.create(poll=self.poll, choice=self.red, voter=self.users[0])
+        response = self.client.get(url)
+        data = json.loads(response.content)
+        self.assertEqual((data['total'], data['tally'][0]['choice']), (1, choice_token(self.red)))
+        etag = response['ETag']
+        # the choices' counters, not the votes, are read
+        with self.assertNumQueries(1):
+            self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        PollChoiceVote.objects.create(poll=self.poll, choice=self.blue, voter=self.users[1])
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+        # with poll versions in the fragment cache no query is needed
+        settings.FRAGMENT_CACHE = 'locmem://'
+        try:
+            get_fragment_cache().clear()
+            response = self.client.get(url)
+            etag, last_modified = response['ETag'], response['Last-Modified']
+            with self.assertNumQueries(0):
+                self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+            self.assertEqual(self.client.get(url, HTTP_IF_MODIFIED_SINCE=last_modified).status_code, 304)
+            self.poll.vote(None, self.blue, voter_ip='10.0.0.1')
+            self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+        finally:
+            get_fragment_cache().clear()
+            settings.FRAGMENT_CACHE = None
+
+    def test_stream(self):
+        publisher = TallyPublisher(threaded=False)
+        old_publisher, publisher_module._publisher = publisher_module._publisher, publisher
+        try:
+            PollChoiceVote.objects.create(poll=self.poll, choice=self.red, voter=self.users[0])
+            request = RequestFactory().get(reverse('pollup_stream', kwargs={'slug': 'best'}))
+            response = stream(request, slug='best')
+            self.assertEqual(response['Content-Type'], 'text/event-stream')
+            events = iter(response)
+            self.assertTrue(events.next().startswith('retry:'))
+            self.assertEqual(events.next(), 'event: tally\ndata: %s\n\n' % json.dumps({choice_token(self.red): 1}))
+
+            # every client of the poll shares one count per tick
+            other = publisher.subscribe(self.poll)
+            PollChoiceVote.objects.create(poll=self.poll, choice=self.blue, voter=self.users[1])
+            PollChoiceVote.objects.create(poll=self.poll, choice=self.red, voter_ip='10.0.0.1')
+            with self.assertNumQueries(1):
+                self.assertEqual(publisher.tick(), 1)
+            self.assertEqual(json.loads(events.next().split('data: ')[1]),
+                {choice_token(self.red): 1, choice_token(self.blue): 1})
+            self.assertEqual(other.get(0), ('delta', {(PollChoice, self.red.pk): 1, (PollChoice, self.blue.pk): 1}))
+            self.assertEqual(publisher.tick(), 0)
+
+            response.close()
+            other.close()
+            self.assertEqual(publisher.polls, {})
+        finally:
+            publisher_module._publisher = old_publisher
+
+    def test_stream_starts_at_subscription(self):
+        publisher = TallyPublisher(threaded=False)
+        old_publisher, publisher_module._publisher = publisher_module._publisher, publisher
+        try:
+            other = publisher.subscribe(self.poll)
+            response = stream(RequestFactory().get('/'), slug='best')
+            # a tick between subscribing and the first read is sent once, as a delta
+            PollChoiceVote.objects.create(poll=self.poll, choice=self.red, voter=self.users[0])
+            publisher.tick()
+            events = list(itertools.islice(response, 3))
+            self.assertEqual(events[1:], [
+                'event: tally\ndata: {}\n\n',
+                'event: delta\ndata: %s\n\n' % json.dumps({choice_token(self.red): 1}),
+            ])
+            response.close()
+            other.close()
+        finally:
+            publisher_module._publisher = old_publisher
+
@@ -3,6 +3,8 @@
 from django.conf.urls.defaults import patterns, url
 
 
-urlpatterns = patterns('',
-    url(r'^$', 'views.index', name='index'),
+urlpatterns = patterns('pollup.views',
+    url(r'^(?P<slug>[-\w]+)/vote/$', 'vote', name='pollup_vote'),
+    url(r'^(?P<slug>[-\w]+)/results/$', 'results', name='pollup_results'),
+    url(r'^(?P<slug>[-\w]+)/stream/$', 'stream', name='pollup_stream'),
 )
@@ -1,8 +1,149 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import hashlib
+import json
+import Queue
+
 from django.contrib.auth.decorators import login_required
+from django.core.exceptions import ValidationError
 from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
-from django.http import HttpResponseRedirect, HttpResponseForbidden, Http404
+from django.core.urlresolvers import reverse
+from django.http import (HttpResponse, HttpResponseRedirect, HttpResponseForbidden,
+    HttpResponseBadRequest, HttpResponseNotModified, Http404)
 from django.shortcuts import get_object_or_404, render
+from django.utils.http import http_date, is_safe_url, parse_etags, parse_http_date_safe, quote_etag
+from django.utils.translation import ugettext as _
 from django.views.decorators.cache import never_cache, cache_page
 from django.views.decorators.http import require_http_methods
+
+from pollup import settings
+from pollup.cache import poll_versions
+from pollup.lookups import lookup_poll, lookup_choice
+from pollup.models import Poll, choice_token, get_content_type
+from pollup.publisher import get_publisher
+
+def wants_json(request):
+    return request.is_ajax() or 'application/json' in request.META.get('HTTP_ACCEPT', '')
+
+def json_response(data, status=200):
+    return HttpResponse(json.dumps(data), content_type='application/json', status=status)
+
+
+@require_http_methods(['POST'])
+def vote(request, slug, poll_model=Poll):
+    """
+    Vote for the choice posted as ``choice`` (see choice_token). The poll and
+    its choice ids come from in-process maps, so a vote costs its INSERTs and
+    the counter UPDATE; duplicates are caught by the database constraint.
+    """
+    poll = lookup_poll(poll_model, slug)
+    voter = request.user if request.user.is_authenticated() else None
+    if poll.require_auth and voter is None:
+        message = _(u"Log in to vote in this poll")
+        if wants_json(request):
+            return json_response({'ok': False, 'errors': [message]}, status=403)
+        return HttpResponseForbidden(message)
+    try:
+        choice = lookup_choice(poll, request.POST.get('choice', ''))
+        poll.vote(voter, choice, voter_ip=request.META.get('REMOTE_ADDR', ''))
+    except ValidationError, e:
+        if wants_json(request):
+            return json_response({'ok': False, 'errors': e.messages}, status=400)
+        return HttpResponseBadRequest(u' '.join(e.messages))
+    if wants_json(request):
+        return json_response({'ok': True})
+    next_url = request.POST.get('next')
+    if not next_url or not is_safe_url(next_url, host=request.get_host()):
+        next_url = reverse('pollup_results', kwargs={'slug': slug})
+    return HttpResponseRedirect(next_url)
+
+def results_state(poll):
+    """
+    (ETag source, Last-Modified timestamp or None), read without touching the
+    votes: the poll's version when the fragment cache keeps one, otherwise
+    its choices' vote counters.
+    """
+    version = poll_versions(poll.__class__, poll.pk).get(poll.pk)
+    if version is not None:
+        return version, int(version, 16) // 1000000
+    counts = []
+    for choice_model in poll.choices_models():
+        content_type_id = get_content_type(choice_model).pk
+        counts.extend((content_type_id, pk, count) for pk, count in
+            choice_model._default_manager.filter(poll=poll).values_list('pk', 'vote_count'))
+    return repr(sorted(counts)), None
+
+@require_http_methods(['GET', 'HEAD'])
+def results(request, slug, poll_model=Poll):
+    """
+    The poll's tally as JSON. The ETag, and Last-Modified when FRAGMENT_CACHE
+    keeps poll versions, change with the votes, so clients polling with
+    If-None-Match/If-Modified-Since get cheap 304s.
+    """
+    poll = lookup_poll(poll_model, slug)
+    state, last_modified = results_state(poll)
+    etag = hashlib.md5('%s:%s:%s' % (get_content_type(poll).pk, poll.pk, state)).hexdigest()
+
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if_modified_since = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+    if if_none_match is not None:
+        not_modified = etag in parse_etags(if_none_match) or '*' in parse_etags(if_none_match)
+    else:
+        not_modified = (if_modified_since is not None and last_modified is not None and
+            last_modified <= if_modified_since)
+    if not_modified:
+        response = HttpResponseNotModified()
+    else:
+        poll_results = poll.results()
+        response = json_response({
+            'poll': poll.slug,
+            'total': sum(poll_results['tally'].values()),
+            'tally': [{'choice': choice_token(choice), 'label': unicode(choice.content_object),
+                'count': poll_results['tally'].get((choice.__class__, choice.pk), 0)}
+                for choice in poll_results['standings']],
+        })
+    response['ETag'] = quote_etag(etag)
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(last_modified)
+    response['Cache-Control'] = 'no-cache'
+    return response
+
+def sse_event(kind, tally):
+    # one server-sent event, choices named by their choice_token
+    data = dict(('%s-%s' % (get_content_type(choice_model).pk, choice_pk), count)
+        for (choice_model, choice_pk), count in tally.items())
+    return 'event: %s\ndata: %s\n\n' % (kind, json.dumps(data))
+
+def event_stream(subscription, keepalive=None):
+    """
+    The full tally, then a ``delta`` event whenever the publisher sees votes.
+    Closing the generator, as the server does when the client goes away,
+    ends the subscription.
+    """
+    keepalive = keepalive or settings.STREAM_KEEPALIVE
+    try:
+        yield 'retry: %d\n\n' % (subscription.publisher.interval * 1000)
+        yield sse_event('tally', subscription.tally)
+        while True:
+            try:
+                kind, data = subscription.get(keepalive)
+            except Queue.Empty:
+                yield ': keepalive\n\n'
+                continue
+            if subscription.overflowed:
+                yield sse_event('tally', subscription.resync())
+            else:
+                yield sse_event(kind, data)
+    finally:
+        subscription.close()
+
+@require_http_methods(['GET'])
+def stream(request, slug, poll_model=Poll):
+    """
+    Server-sent events with the poll's tally changes. Every connection holds
+    a server thread, all of them share the publisher's counting.
+    """
+    poll = lookup_poll(poll_model, slug)
+    response = HttpResponse(event_stream(get_publisher().subscribe(poll)), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    return response